@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+'''usage: bench.py [-h] [-o OUTPUT] [-b BASELINE] [-t TOLERANCE]
+                [-s SIZES [SIZES ...]] [-k FILTER]
+
+Time loadconfig on generated configs and compare against a saved baseline.
+
+Benchmarks cover Config construction, $key interpolation, Odict load and
+dump, ConfigNode compaction, !include pre-processing, clg parsing and export
+for flat configs and chains of $references of each size, deep nesting,
+include fan-out and large clg subparser trees. Results are written as json
+with the best time per call in seconds. With a baseline, the run fails when
+any benchmark is slower than the baseline by more than the tolerance. A
+baseline is the json output of an earlier run, eg: build/bench.json copied
+aside before a change.
+
+Run as:  just bench [baseline.json]
+    or:  python benchmarks/bench.py -o build/bench.json [-b baseline.json]
+'''
+
+from os.path import abspath, dirname
+import sys
+# Benchmark the source tree this script belongs to
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from functools import partial
+import json
+from loadconfig import Config
+from loadconfig.lib import (CLG_PARSERS, Loader, Odict, tempdir, write_file,
+    _clg_parse)
+from loadconfig.node import compact
+import platform
+from time import perf_counter
+
+conf = """\
+    clg:
+        description: Time loadconfig and compare against a saved baseline.
+        options:
+            output: {short: o, default: bench.json,
+                     help: json file to write results to}
+            baseline: {short: b, default: '',
+                       help: json results to compare against}
+            tolerance: {short: t, type: float, default: 0.25,
+                        help: allowed slowdown ratio over the baseline}
+            sizes: {short: s, type: int, nargs: '+',
+                    default: [10, 1000, 100000],
+                    help: keys of the generated flat configs and chains}
+            filter: {short: k, default: '',
+                     help: only run benchmarks containing this string}"""
+
+# Nesting depth, bounded by recursion in the yaml composer
+NESTING = 50
+INCLUDE_FILES = 50
+SUBPARSERS = 50
+
+
+def flat(n):
+    '''Yaml string with n top level keys'''
+    return '\n'.join(f'key{i}: value {i}' for i in range(n))
+
+
+def chain(n):
+    '''Yaml string with a chain of n $references, values keeping their size'''
+    lines = ['key0: /root'] + [f'key{i}: $key{i - 1}' for i in range(1, n)]
+    return '\n'.join(reversed(lines))
+
+
+def nested(depth):
+    '''Yaml string with mappings nested depth levels'''
+    return '\n'.join(f'{"  " * i}level{i}:' for i in range(depth)) + ' leaf'
+
+
+def clg_spec(subparsers):
+    '''clg spec with subparsers each having a few options and args'''
+    return Odict({'clg': {'subparsers': {f'cmd{i}': {
+        'help': f'command {i}',
+        'options': {f'opt{j}': {'short': chr(105 + j), 'help': f'option {j}'}
+            for j in range(8)},
+        'args': {'target': {'nargs': '*', 'help': 'targets'}}}
+        for i in range(subparsers)}}})
+
+
+def clg_parse(spec, cold):
+    if cold:
+        CLG_PARSERS.clear()
+    return _clg_parse(spec, ['bench', 'cmd7', '-i', 'x', 'target'], set())
+
+
+def expand_keys(yaml_string):
+    Config()._expand_keys(yaml_string)
+
+
+def benchmarks(sizes, workdir):
+    '''Yield (name, function) pairs to time'''
+    for n in sizes:
+        config_string = flat(n)
+        config = Config(config_string)
+        yield f'config_flat_{n}', partial(Config, config_string)
+        yield f'odict_load_{n}', partial(Odict.load, config_string)
+        yield f'odict_dump_{n}', partial(repr, config)
+        yield f'odict_dump_block_{n}', partial(str, config)
+        yield f'export_{n}', config.export
+        yield f'compact_{n}', partial(compact, config)
+        yield f'expand_keys_chain_{n}', partial(expand_keys, chain(n))
+    nested_string = nested(NESTING)
+    yield f'config_nested_{NESTING}', partial(Config, nested_string)
+    yield f'odict_dump_nested_{NESTING}', partial(str, Odict(nested_string))
+    main_lines = []
+    for i in range(INCLUDE_FILES):
+        write_file(f'{workdir}/inc{i}.yml', flat(20).replace('key', f'f{i}_'))
+        main_lines.append(f'!include {workdir}/inc{i}.yml')
+    main_string = '\n'.join(main_lines)
+    yield f'pre_include_fanout_{INCLUDE_FILES}', partial(
+        Loader('').pre_include, main_string)
+    yield f'config_include_fanout_{INCLUDE_FILES}', partial(
+        Config, main_string)
+    spec = clg_spec(SUBPARSERS)
+    yield f'clg_parse_cold_{SUBPARSERS}', partial(clg_parse, spec.clg, True)
+    yield f'clg_parse_warm_{SUBPARSERS}', partial(clg_parse, spec.clg, False)
+    yield f'config_clg_{SUBPARSERS}', partial(Config, Odict.dump(spec),
+        ['bench', 'cmd7', '-i', 'x'])
+
+
+def measure(function, min_time=0.05, repeat=5):
+    '''Return best time per call in seconds over repeat rounds'''
+    start = perf_counter()
+    function()
+    elapsed = perf_counter() - start
+    number = max(1, int(min_time / max(elapsed, 1e-9)))
+    best = elapsed
+    for _ in range(repeat):
+        start = perf_counter()
+        for _ in range(number):
+            function()
+        best = min(best, (perf_counter() - start) / number)
+    return best
+
+
+def compare(results, baseline, tolerance):
+    '''Return names of results slower than baseline beyond tolerance'''
+    regressions = []
+    for name, seconds in results.items():
+        if name not in baseline:
+            continue
+        ratio = seconds / baseline[name]
+        flag = ratio > 1 + tolerance
+        print(f'{name:32} {baseline[name]:12.6f} {seconds:12.6f} '
+            f'{ratio:6.2f}{"  REGRESSION" if flag else ""}', file=sys.stderr)
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main(args):
+    c = Config(conf, args)
+    results = {}
+    with tempdir() as workdir:
+        for name, function in benchmarks(c.sizes, workdir):
+            if c.filter in name:
+                results[name] = measure(function)
+                print(f'{name:32} {results[name]:12.6f}', file=sys.stderr)
+    write_file(c.output, json.dumps({'python': platform.python_version(),
+        'results': results}, indent=2) + '\n')
+    if c.baseline:
+        with open(c.baseline) as fh:
+            baseline = json.load(fh)['results']
+        if compare(results, baseline, c.tolerance):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,14 +1,17 @@
 '''loadconfig python library'''
 from __future__ import print_function
-__all__ = ['Config', 'Odict', '__version__']
+__all__ = ['Config', 'LazyConfig', 'Odict', '__version__']
 
 __author__ = 'Daniel Mizyrycki'
 __version__ = '0.2.1'
 
-from itertools import count
-from .lib import (Odict, delregex, dfl, findregex, flatten,
-    read_config_file, _clg_parse, _get_option)
-from shlex import quote as shlex_quote
+from .lib import (EXPORT_DIALECTS, MAPPING_TAG, Odict, check_schema,
+    file_cache, interpolate, load_config_file, track_sources, _check_code,
+    _clg_parse, _compose, _dollar, _export_words, _Pending, _refs, _render,
+    _scalar, _scan_node, _scan_options, _source_paths, _sources, _stamps,
+    _stat)
+from .node import compact
+from os import environ
 from string import Template
 
 
@@ -48,22 +51,100 @@ class Config(Odict):
     >>> c.host
     'leon'
     '''
-    # Try up to max times to expand $ keys
-    expand_max = 5
+    # Directory caching parsed -C config files. No caching if empty
+    _cache_dir = environ.get('LOADCONFIG_CACHE', '')
+    # FileCache shared by Config objects, eg: FileCache(validate=True), also
+    # letting reload skip unchanged files. Files are otherwise read and
+    # parsed once per load, keeping only their stamps for reload
+    _file_cache = None
 
     def __init__(self, config_data='', args=None, version=None, types=set()):
-        '''Initialize config object. Keep its __dict__ clean for easy access'''
+        '''Initialize config object. Keep its __dict__ clean for easy access:
+        only the inputs and sources needed by reload are kept there.
+        '''
         super().__init__()
         if config_data == '' and args is None:
             return
+        self.__dict__['_inputs'] = (config_data, args and list(args), version,
+            types)
         if version:
             self.version = version
         if args and 'clg' in config_data:
             self.prog = args[0]
-        self._expand_keys(config_data)
-        args = self._load_options(args)
-        self._load_config_cli(args, types)
-        self._checkconfig()
+        with file_cache(self._file_cache) as cache, \
+                track_sources() as sources:
+            # Read -C and !include files concurrently, then load in order
+            cache.prefetch(_source_paths(config_data, args))
+            self._expand_keys(config_data)
+            args = self._load_options(args)
+            self._load_config_cli(args, types)
+            self._checkconfig(types)
+        self.__dict__['_sources'] = sources, _stamps(sources, cache)
+
+    def reload(self):
+        r'''Rebuild config if a file or !env envvar it was loaded from changed.
+        With a shared _file_cache, unchanged files are not read again. Return
+        the changed keys as {key: (old value, new value)}, None standing for
+        a missing key. A rebuild replaces keys set by hand since loading,
+        removing the ones the sources do not have.
+
+        >>> from loadconfig.lib import tempfile
+        >>> with tempfile() as fh:
+        ...     _ = fh.write('db: {host: pg}\nport: 5432')
+        ...     fh.flush()
+        ...     c = Config('url: $db:$port', ['', f'-C={fh.name}'])
+        ...     c.reload()
+        ...     _ = fh.write('\npool: 4')
+        ...     fh.flush()
+        ...     c.reload()
+        {}
+        {pool: [null, 4]}
+        '''
+        if '_sources' not in self.__dict__:
+            return Odict()
+        sources, stamps = self._sources
+        if sources.unchanged(env_only=True) and all(
+                _stat(path) == stamp for path, stamp in stamps.items()):
+            return Odict()
+        new = type(self)(*self._inputs)
+        diff = Odict()
+        for key in list(self) + [k for k in new if k not in self]:
+            old_value, new_value = self.get(key), new.get(key)
+            if key not in self or key not in new or old_value != new_value:
+                diff[key] = (old_value, new_value)
+        # Keys present before and after are never missing for readers
+        dict.update(self, new.items())
+        for key in [k for k in diff if k not in new]:
+            dict.__delitem__(self, key)
+        self.__dict__.update(new.__dict__)
+        return diff
+
+    def freeze(self):
+        r'''Return an immutable, hashable snapshot of config as a ConfigNode.
+        Variants built with its set and update methods share the unchanged
+        subtrees, so there is no need for defensive deep copies.
+
+        >>> c = Config('db: {host: pg, port: 5432}\nworkers: 4')
+        >>> snapshot = c.freeze()
+        >>> variant = snapshot.set('db:host', 'mysql')
+        >>> variant.db, snapshot.db.host, hash(snapshot) == hash(c.freeze())
+        ({host: mysql, port: 5432}, 'pg', True)
+        '''
+        return compact(self)
+
+    @classmethod
+    async def aload(cls, config_data='', args=None, version=None,
+            types=set()):
+        '''Return Config built in a worker thread, so reading -C, !include
+        and !read files does not block the event loop. Loads share no global
+        state and can run concurrently.
+
+        >>> import asyncio
+        >>> asyncio.run(Config.aload('hi: there', ['', '-E=bye: now']))
+        {hi: there, bye: now}
+        '''
+        import asyncio
+        return await asyncio.to_thread(cls, config_data, args, version, types)
 
     def _expand_keys(self, config_data=''):
         '''Add config_data into config and interpolate $keys.
@@ -75,32 +156,27 @@ class Config(Odict):
         '/data/data.txt'
         '''
         self.update(config_data)
-        # Convert self to text for full key interpolation
-        config_string = str(self)
-        n = count()
-        while '$' in config_string and next(n) < self.expand_max:
-            config_string = self.render(config_string)
-            self.update(config_string)
+        if any(_refs(self.get('checkconfig'))):
+            self.__dict__['_check_refs'] = True
+        interpolate(self)
 
     def _load_config_file(self, filepath):
-        '''Return config file adding data from loadconfig.template keyword'''
-        datafile = read_config_file(filepath)
-        self._expand_keys(datafile)
-        return datafile
+        '''Return config file parsed as Odict, cached on cache_dir'''
+        return load_config_file(filepath, self._cache_dir)
 
     def _load_options(self, args):
         '''Load config from options -E and -C from cli arguments.
 
         >>> c = Config()
-        >>> c._load_options(['-E="data_file: data.txt"'])
-        []
+        >>> c._load_options(['prog', '-E="data_file: data.txt"', '-v'])
+        ['prog', '-v']
         >>> c.data_file
         'data.txt'
         '''
         if args is None:
             return
-        for arg in findregex('^(-E|-C)=', args):
-            config_string, option = _get_option(arg)
+        options, rest = _scan_options(args)
+        for option, config_string in options:
             if option == 'C':
                 # Expand $ keys in file name
                 config_string = self.render(config_string)
@@ -109,7 +185,7 @@ class Config(Odict):
                 self.prog = args[0]
             self._expand_keys(config_string)
         # Prevent clg seeing -E or -C options
-        return delregex('^(-E|-C)=', args)
+        return rest
 
     def _load_config_cli(self, args, types=set()):
         '''Load config parsing cli arguments with clg.
@@ -133,8 +209,12 @@ class Config(Odict):
         self._expand_keys(clg_args)  # Add config from cli args
         del self['clg']  # Remove clg key from Config
 
-    def _checkconfig(self):
-        '''Check configuration using keyword checkconfig
+    def _checkconfig(self, types=set()):
+        '''Check configuration using keywords checkschema and checkconfig.
+        checkschema is declarative (see lib.check_schema), coercing values
+        to their types, custom types included. checkconfig is
+        python code, compiled once and run with self as the config. $keys
+        are interpolated again only if some $ is left after it ran.
 
         >>> c = Config("""
         ...         action: stop
@@ -145,32 +225,62 @@ class Config(Odict):
         Traceback (most recent call last):
             ...
         Exception: Stopping now.
+        >>> Config("""
+        ...         action: stop
+        ...         checkschema: {action: {choices: [start]}}""")
+        Traceback (most recent call last):
+            ...
+        loadconfig.lib.SchemaError: checkschema errors:
+          action: stop is not one of [start]
+        >>> Config('{port: "80", checkschema: {port: int}}').port
+        80
         '''
+        if 'checkschema' in self:
+            check_schema(self, self.checkschema, types)
+            del self['checkschema']
+        # checkconfig rendered from $keys changes with their values: it is
+        # compiled once per process but not kept on _cache_dir
+        rendered = self.__dict__.pop('_check_refs', False)
         if 'checkconfig' in self:
-            exec(self.checkconfig)
-            self._expand_keys('')
+            if _sources.get() is not None:
+                _sources.get().checked = True
+            exec(_check_code(self.checkconfig,
+                '' if rendered else self._cache_dir))
             del self['checkconfig']
+            if _dollar(self):
+                self._expand_keys('')
 
-    def export(self):
+    def export(self, dialect='sh', file=None):
         '''Export the config for shell usage.
         Keys are uppercased. List-like keys are flattened.
+        dialect: sh, bash (lists as arrays), fish, dotenv or env0 (NUL
+        terminated, as read by env -0). Lines are written to file if given,
+        otherwise returned as a string.
 
-        >>> c = Config('activity: hanggliding')
+        >>> c = Config('activity: hanggliding, gear: [wing, harness]')
         >>> c.export()
-        'export ACTIVITY="hanggliding"'
+        'export ACTIVITY="hanggliding"\\nexport GEAR="wing harness"'
+        >>> import sys
+        >>> c.export('fish', sys.stdout)
+        set -gx ACTIVITY 'hanggliding'
+        set -gx GEAR 'wing' 'harness'
         '''
-        retval = ''
-        for key in self:
-            val = dfl(self[key])
-            # Make list-like keys shell friendly
-            if isinstance(val, (list, tuple)):
-                val = flatten(val)
-                val = ' '.join([shlex_quote(e) for e in val])
-            elif isinstance(val, dict):
-                val = repr(val)
-            retval += 'export {}="{}"\n'.format(
-                key.upper().replace(' ', '_'), val)
-        return retval[:-1]
+        if file is not None:
+            file.writelines(self.export_lines(dialect))
+            return
+        retval = ''.join(self.export_lines(dialect))
+        return retval[:-1] if retval.endswith('\n') else retval
+
+    def export_lines(self, dialect='sh'):
+        '''Yield export lines of dialect, see export.
+
+        >>> list(Config('activity: hanggliding').export_lines('dotenv'))
+        ['ACTIVITY="hanggliding"\\n']
+        '''
+        line = EXPORT_DIALECTS[dialect]
+        for key, value in self.items():
+            yield line(str(key).upper().replace(' ', '_'),
+                *_export_words(value))
 
     def render(self, template):
         '''Render a string template
@@ -215,3 +325,216 @@ class Config(Odict):
 
     def __str__(self):
         return str(Odict(self))
+
+
+class LazyConfig(Config):
+    '''Config constructing yaml sections and interpolating $keys on access.
+
+    Top level keys of yaml sources are kept as yaml nodes until first read.
+    Results are the same as Config. As Config interpolates every key once per
+    merged source (eg: -E options), pending keys are interpolated when the
+    next source is merged, so only the last merge is deferred. Keys are
+    resolved before any key they reference changes, and sections with tags
+    (eg: !include) are constructed right away in document order. Cyclic $key
+    references raise ValueError when accessed.
+
+    >>> c = LazyConfig("""
+    ...         root: /srv
+    ...         data: $root/data
+    ...         hosts: [leon, sasha]""")
+    >>> c.data
+    '/srv/data'
+    >>> type(dict.__getitem__(c, 'hosts')).__name__
+    '_Pending'
+    >>> c
+    {root: /srv, data: /srv/data, hosts: [leon, sasha]}
+    '''
+    def __init__(self, *args, **kwargs):
+        # Keys interpolated in the pass of the last merge still having $
+        self.__dict__.update(_dependents={}, _dollars=set(), _loading=True)
+        super().__init__(*args, **kwargs)
+        self.__dict__['_loading'] = False
+
+    def _expand_keys(self, config_data=''):
+        '''Add config_data into config for later construction and $keys
+        interpolation.
+
+        >>> c = LazyConfig()
+        >>> c._expand_keys('data_path: /data, data_file: $data_path/data.txt')
+        >>> c.data_file
+        '/data/data.txt'
+        '''
+        entries = self._entries(config_data)
+        # Config interpolates every key once per merge. Pending keys wait
+        # for the pass of the last merge: finish it before this one.
+        for key in list(dict.keys(self)):
+            entry = dict.__getitem__(self, key)
+            if isinstance(entry, _Pending) and entry.dollar:
+                self._resolve(key)
+        for key in list(self._dollars):
+            self._store(key, _Pending(dict.__getitem__(self, key)))
+        for key, entry in entries.items():
+            self._store(key, entry)
+        if 'checkconfig' in entries and entries['checkconfig'].refs:
+            self.__dict__['_check_refs'] = True
+        if dict.__contains__(self, '_'):
+            dict.__delitem__(self, '_')
+        # Top level $keys add their rendered key, as interpolate does
+        for key in [k for k in self if isinstance(k, str) and '$' in k]:
+            new = _scalar(Template(key).safe_substitute(self))
+            if new != key:
+                self[new] = self[key]
+
+    def _entries(self, config_data):
+        '''Return config_data top level keys as pending entries'''
+        if isinstance(config_data, str):
+            loader, node = _compose(config_data)
+            if node is None:
+                return {}
+            if node.tag == MAPPING_TAG and not any(
+                    '$' in str(k.value) for k, v in node.value):
+                loader.flatten_mapping(node)
+                entries = {}
+                for key_node, value_node in node.value:
+                    key = loader.construct_object(key_node, deep=True)
+                    refs, dollar, tagged = _scan_node(value_node)
+                    if tagged:  # Construct now to keep tags document order
+                        value = loader.construct_object(value_node, deep=True)
+                        entries[key] = _Pending(value)
+                    else:
+                        entries[key] = _Pending(loader=loader,
+                            node=value_node, refs=refs, dollar=dollar)
+                return entries
+            config_data = loader.construct_document(node)
+        return {k: _Pending(v) for k, v in Odict(config_data).items()}
+
+    def _store(self, key, entry):
+        '''Store entry as pending if it needs construction or interpolation'''
+        self._dollars.discard(key)
+        if entry.node is None and not entry.dollar:
+            dict.__setitem__(self, key, entry.value)
+            return
+        dict.__setitem__(self, key, entry)
+        for ref in entry.refs:
+            self._dependents.setdefault(ref, set()).add(key)
+
+    def _force_dependents(self, keys):
+        '''Resolve pending keys referencing keys, directly or not'''
+        stack, dependents = list(keys), set()
+        while stack:
+            for key in self._dependents.get(stack.pop(), ()):
+                if key not in dependents:
+                    dependents.add(key)
+                    stack.append(key)
+        for key in dependents:
+            if isinstance(dict.get(self, key), _Pending):
+                self._resolve(key)
+
+    def _resolve(self, key):
+        '''Construct and interpolate a pending key, after the pending keys
+        it references, as interpolate does. Return its value.
+        '''
+        path, on_path = [key], {key}
+        stack = [(key, iter(dict.__getitem__(self, key).refs))]
+        while stack:
+            current, refs = stack[-1]
+            for ref in refs:
+                entry = dict.get(self, ref)
+                if isinstance(entry, _Pending) and entry.dollar:
+                    if ref in on_path:
+                        cycle = path[path.index(ref):] + [ref]
+                        raise ValueError('Cyclic $key reference: {}'.format(
+                            ' -> '.join(map(str, cycle))))
+                    path.append(ref)
+                    on_path.add(ref)
+                    stack.append((ref, iter(entry.refs)))
+                    break
+            else:
+                stack.pop()
+                on_path.discard(path.pop())
+                entry = dict.__getitem__(self, current)
+                value = entry.construct()
+                if entry.dollar:
+                    value = _render(value, self)
+                    if self._loading and _dollar(value):
+                        self._dollars.add(current)
+                dict.__setitem__(self, current, value)
+        return value
+
+    def _force(self):
+        '''Resolve all pending keys'''
+        for key in dict.keys(self):
+            self[key]
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if isinstance(value, _Pending):
+            value = self._resolve(key)
+        return value
+
+    def __setitem__(self, key, value):
+        # Keys referencing key are interpolated with its previous value
+        self._force_dependents([key])
+        dict.__setitem__(self, key, value)
+        if self._loading and _dollar(value):
+            self._dollars.add(key)
+        else:
+            self._dollars.discard(key)
+
+    def __delitem__(self, key):
+        self._force_dependents([key])
+        dict.__delitem__(self, key)
+        self._dollars.discard(key)
+
+    def __iter__(self):
+        # Overriding __iter__ makes dict(c) go through __getitem__
+        return dict.__iter__(self)
+
+    def __eq__(self, other):
+        self._force()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __reduce_ex__(self, protocol):
+        '''Pickle and copy as a Config with all keys resolved'''
+        return Config, (), None, None, iter(self.items())
+
+    def copy(self):
+        return dict(self.items())
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def items(self):
+        self._force()
+        return dict.items(self)
+
+    def values(self):
+        self._force()
+        return dict.values(self)
+
+    def pop(self, key, *default):
+        if key not in self:
+            return dict.pop(self, key, *default)
+        value = self[key]
+        del self[key]
+        return value
+
+    def popitem(self):
+        self._force()
+        return dict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in Odict(*args, **kwargs).items():
+            self[key] = value
+        if '_' in self:
+            del self['_']
@@ -0,0 +1,56 @@
+'''loadconfig server client.
+
+Only uses the standard library, so scripts/loadconfig can load it without
+importing loadconfig (yaml, clg and argparse) when a server answers. A
+request is a json object with the script conf, its args, cwd and
+environment. The response has the stdout, stderr and exit code the script
+would have produced.
+'''
+__all__ = ['listening', 'request', 'stop']
+
+import json
+import os
+import socket
+import sys
+
+
+def request(socket_path, conf, args, spawn=True, timeout=10):
+    '''Return server response for a script request, None if unavailable.
+    With spawn, start a server on socket_path when none is listening.
+    '''
+    payload = {'conf': conf, 'args': args, 'cwd': os.getcwd(),
+        'env': dict(os.environ)}
+    try:
+        return _send(socket_path, payload, timeout)
+    except (ConnectionRefusedError, FileNotFoundError):
+        if spawn:
+            from subprocess import DEVNULL, Popen
+            Popen([sys.executable, '-m', 'loadconfig.server', socket_path],
+                cwd='/', stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL,
+                start_new_session=True)
+    except (OSError, ValueError):
+        pass
+
+
+def stop(socket_path, timeout=10):
+    '''Ask the server on socket_path to exit'''
+    _send(socket_path, {'stop': True}, timeout)
+
+
+def _send(socket_path, payload, timeout):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(payload).encode())
+        sock.shutdown(socket.SHUT_WR)
+        return json.loads(b''.join(iter(lambda: sock.recv(65536), b'')))
+
+
+def listening(socket_path):
+    '''Return True if a server is listening on socket_path'''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            return False
+    return True
@@ -4,33 +4,67 @@ pytest is recommented for testing this file.
 For partial manual run:
     python -m doctest lib.py -v
 '''
-__all__ = ['addpath', 'capture_stream', 'delregex', 'dfl', 'exc', 'findregex',
-    'import_file', 'read_config_file', 'ppath', 'Run', 'run', 'tempdir',
-    'tempfile']
+__all__ = ['addpath', 'arun', 'attach', 'capture_stream', 'check_schema',
+    'delregex', 'dfl', 'exc', 'findregex', 'file_cache', 'FileCache',
+    'import_file', 'interpolate', 'load_config_file', 'read_config_file',
+    'ppath', 'publish', 'run', 'run_batch', 'SchemaError', 'Sources',
+    'tempdir', 'tempfile', 'track_sources', 'yaml_backend',
+    'AsyncRun', 'Run']  # noqa: F822 imported on first use by __getattr__
 __author__ = 'Daniel Mizyrycki'
 
-import argparse
-import clg
+from bisect import bisect_right
 from collections import deque
 from contextlib import contextmanager
-from copy import deepcopy
+from contextvars import ContextVar
 from io import StringIO
-from itertools import count
+from operator import itemgetter
 import os
 from os import remove, environ
-from os.path import basename, dirname, abspath, exists, isdir, isfile
+from os.path import basename, dirname, abspath, exists, getmtime, isdir, isfile
 import re
-import shlex
-from shutil import rmtree
-from signal import SIGTERM
-from subprocess import Popen, PIPE
+from string import Template
 import sys
-from tempfile import mkdtemp, mkstemp
 from textwrap import dedent
+from threading import Lock
 from types import ModuleType
 import yaml
+# argparse, clg, subprocess and tempfile are imported where needed to keep
+# loadconfig import light for programs not parsing cli arguments
 
 MAPPING_TAG = yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG
+STR_TAG = yaml.resolver.BaseResolver.DEFAULT_SCALAR_TAG
+MERGE_TAG = 'tag:yaml.org,2002:merge'
+VALUE_TAG = 'tag:yaml.org,2002:value'
+_resolver = yaml.resolver.Resolver()
+INCLUDE_LINE = re.compile(r'!include ["\']?([\w/.]+)["\']?\s*$')
+# File paths of !include and !read tags, used to prefetch them
+SOURCE_TAG = re.compile(r'!(include|read)\s+["\']?([^\s"\',\]}]+)')
+# Threads reading files concurrently on FileCache.prefetch
+PREFETCH_WORKERS = 8
+# Bump when the parsed config cache format changes
+CACHE_STAMP = 1
+# Config options taken out of cli arguments before clg parses them
+OPTION_ARG = re.compile(r'(?:-([CE])|--(conf|str))(?:=(.*))?\Z', re.S)
+OPTION_NAMES = {'conf': 'C', 'str': 'E'}
+# Compiled clg parsers, least recently used first
+CLG_PARSERS = {}
+CLG_PARSERS_MAX = 32
+_clg_lock = Lock()
+# Compiled checkconfig code objects and checkschema validators, least
+# recently used first
+CHECK_CODES = {}
+SCHEMAS = {}
+CHECKS_MAX = 256
+_checks_lock = Lock()
+# checkschema types
+SCHEMA_TYPES = {'any': object, 'bool': bool, 'float': (int, float),
+    'int': int, 'list': list, 'map': dict, 'str': str}
+# checkschema spec options and the types of their values
+SCHEMA_OPTIONS = {'type': str, 'required': bool, 'default': object,
+    'choices': list, 'min': (int, float), 'max': (int, float), 'match': str,
+    'keys': dict, 'items': (str, dict)}
+_sources = ContextVar('loadconfig_sources', default=None)
+_cache = ContextVar('loadconfig_file_cache', default=None)
 
 
 def addpath(path, parent=False):
@@ -69,6 +103,33 @@ def addpath(path, parent=False):
     return path
 
 
+def attach(name):
+    '''Return the object published on shared memory segment name.
+    It is unpickled right from the shared pages, without copying them. Only
+    the publisher removes the segment.
+    '''
+    import pickle
+    if sys.version_info >= (3, 13):  # pragma: no cover
+        from multiprocessing.shared_memory import SharedMemory
+        shm = SharedMemory(name, track=False)
+        try:
+            return pickle.loads(shm.buf)
+        finally:
+            shm.close()
+    # Before 3.13, SharedMemory(name) registers the segment with the
+    # resource tracker, which unlinks it when the attaching process exits
+    # (or, when shared with the publisher, drops its registration). Map it
+    # read only with the same shm_open SharedMemory uses instead.
+    import mmap
+    from _posixshmem import shm_open
+    fd = shm_open(f'/{name}', os.O_RDONLY)
+    try:
+        with mmap.mmap(fd, 0, prot=mmap.PROT_READ) as data:
+            return pickle.loads(data)
+    finally:
+        os.close(fd)
+
+
 @contextmanager
 def capture_stream(stream_name='stdout'):
     r'''Capture stream (stdout/stderr) in a string
@@ -86,6 +147,48 @@ def capture_stream(stream_name='stdout'):
     data.flush()
 
 
+class SchemaError(ValueError):
+    '''checkschema errors. errors keeps the (key path, error) pairs'''
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__('checkschema errors:\n' + '\n'.join(
+            f'  {path}: {error}' for path, error in errors))
+
+
+def check_schema(data, schema, types=()):
+    '''Check and coerce data in place against a checkschema mapping of keys
+    to their specs in a single walk, raising SchemaError with every error and
+    its key path. A spec is a type name or a mapping with type (any, bool,
+    float, int, list, map, str or the name of a function in types), required,
+    default, choices, min and max (values, or lengths of str and list), match
+    (regex), keys (spec of map keys) and items (spec of list elements).
+    Strings (eg: from !env) are typed as yaml scalars for bool, float and int,
+    and functions in types convert their values as clg types do. Validators
+    are compiled once per schema and types. Malformed schemas raise
+    ValueError.
+
+    >>> schema = Odict("""
+    ...     port: {type: int, min: 1, required: true}
+    ...     db: {keys: {host: str, pool: {type: int, max: 8, default: 4}}}
+    ...     tags: {type: list, items: {choices: [web, db]}}""")
+    >>> data = Odict('{port: "80", db: {host: pg}, tags: [web]}')
+    >>> check_schema(data, schema)
+    >>> data
+    {port: 80, db: {host: pg, pool: 4}, tags: [web]}
+    >>> check_schema(Odict('{db: {pool: 16}, tags: [web, mail]}'), schema)
+    Traceback (most recent call last):
+        ...
+    loadconfig.lib.SchemaError: checkschema errors:
+      port: required key is missing
+      db:pool: 16 is above max 8
+      tags:1: mail is not one of [web, db]
+    '''
+    errors = []
+    _schema_validator(schema, types)(data, '', errors)
+    if errors:
+        raise SchemaError(errors)
+
+
 def delregex(regex, args):
     '''Delete all elements with regex from a list of strings
 
@@ -141,12 +244,15 @@ def flatten(l):
     >>> flatten([[1, 2], 3, 4])
     [1, 2, 3, 4]
     '''
-    ret = []
-    for e in l:
-        if isinstance(e, (list, tuple)):
-            ret += flatten(e)
-        else:
+    ret, stack = [], [iter(l)]
+    while stack:
+        for e in stack[-1]:
+            if isinstance(e, (list, tuple)):
+                stack.append(iter(e))
+                break
             ret.append(e)
+        else:
+            stack.pop()
     return ret
 
 
@@ -175,6 +281,60 @@ def import_file(filepath):
     return module
 
 
+def interpolate(data):
+    '''Interpolate $keys on data values in place.
+
+    Top level keys are resolved once in dependency order, walking data
+    instead of rendering it as a yaml string. A value being exactly a $key
+    reference gets a copy of the referenced value. Top level keys having
+    $keys are kept, adding their rendered key. Raise ValueError on cyclic
+    references.
+
+    >>> d = Odict('path: $base/bin, base: $root/usr, root: /opt, n: $nums')
+    >>> d.nums = [1, 2]
+    >>> interpolate(d)
+    >>> d
+    {path: /opt/usr/bin, base: /opt/usr, root: /opt, n: [1, 2], nums: [1, 2]}
+    >>> d = Odict('{$k: 1, k: key}')
+    >>> interpolate(d)
+    >>> d
+    {$k: 1, k: key, key: 1}
+    >>> interpolate(Odict('a: $b, b: $a'))
+    Traceback (most recent call last):
+        ...
+    ValueError: Cyclic $key reference: a -> b -> a
+    '''
+    resolved = set()
+    for root in list(data):
+        if root in resolved:
+            continue
+        # Depth first walk with an explicit stack, as chains can be long
+        path, on_path = [root], {root}
+        stack = [(root, _refs(data[root]))]
+        while stack:
+            key, refs = stack[-1]
+            for ref in refs:
+                if ref in data and ref not in resolved:
+                    if ref in on_path:
+                        cycle = path[path.index(ref):] + [ref]
+                        raise ValueError('Cyclic $key reference: {}'.format(
+                            ' -> '.join(map(str, cycle))))
+                    path.append(ref)
+                    on_path.add(ref)
+                    stack.append((ref, _refs(data[ref])))
+                    break
+            else:
+                stack.pop()
+                on_path.discard(path.pop())
+                data[key] = _render(data[key], data)
+                resolved.add(key)
+    # Top level $keys add their rendered key, as yaml round-trips did
+    for key in [k for k in data if isinstance(k, str) and '$' in k]:
+        new = _scalar(Template(key).safe_substitute(data))
+        if new != key:
+            data[new] = data[key]
+
+
 def last(it):
     '''Get last element of an iterator. Return None if empty.
 
@@ -196,18 +356,255 @@ def ppath(path):
     return dirname(abspath(path))
 
 
+@contextmanager
+def publish(obj):
+    '''Pickle obj once to shared memory, yielding the segment name for other
+    processes (eg: a multiprocessing pool initializer) to attach to. Tasks
+    then only send the name. The segment is removed on exit.
+
+    >>> with publish(Odict('db: {host: pg}')) as name:
+    ...     attach(name).db.host
+    'pg'
+    '''
+    import pickle
+    from multiprocessing.shared_memory import SharedMemory
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    shm = SharedMemory(create=True, size=len(data))
+    try:
+        shm.buf[:len(data)] = data
+        yield shm.name
+    finally:
+        shm.close()
+        shm.unlink()
+
+
 def read_file(file_path):
-    with exc(IOError), open(file_path) as fh:
-        return str(fh.read())
-    return ''
+    '''Return file content or an empty string if it can not be read.
+    The file is read through the active file_cache and recorded on the
+    active track_sources scope.
+    '''
+    cache = _cache.get()
+    data = cache.text(file_path) if cache else _read(file_path)
+    sources = _sources.get()
+    if sources is not None and abspath(file_path) not in sources.files:
+        sources.files[abspath(file_path)] = _digest(data)
+    return data or ''
 
 
 def read_config_file(config_path):
+    '''Return config file content. Directories default to config.conf
+
+    >>> read_config_file('/')
+    ''
+    '''
     if isdir(config_path):
         config_path = '{}/config.conf'.format(config_path)
     return(read_file(config_path))
 
 
+def load_config_file(config_path, cache_dir=''):
+    '''Return config file parsed as Odict.
+    With cache_dir, the parsed Odict is pickled there and reused for as long
+    as the config file, its !include and !read files and its !env envvars
+    stay the same. cache_dir is trusted: keep it private to its user.
+
+    >>> with tempdir() as tmpdir:
+    ...     _ = write_file(f'{tmpdir}/a.yml', 'a: 1')
+    ...     d = load_config_file(f'{tmpdir}/a.yml', cache_dir=tmpdir)
+    ...     _ = write_file(f'{tmpdir}/a.yml', 'a: 2')
+    ...     d, load_config_file(f'{tmpdir}/a.yml', cache_dir=tmpdir)
+    ({a: 1}, {a: 2})
+    '''
+    if isdir(config_path):
+        config_path = '{}/config.conf'.format(config_path)
+    if not cache_dir:
+        return Odict(read_file(config_path))
+    import pickle
+    from tempfile import mkstemp
+    # Relative !include paths depend on the current directory
+    key = '{}\0{}'.format(abspath(config_path), os.getcwd())
+    cache_path = '{}/{}.pickle'.format(cache_dir, _digest(key))
+    with exc(Exception):
+        with open(cache_path, 'rb') as fh:
+            stamp, sources, data = pickle.load(fh)
+        if stamp == CACHE_STAMP and sources.unchanged():
+            # Record the sources of the cached load, as a load would
+            if _sources.get() is not None:
+                _sources.get().update(sources)
+            return data
+    with track_sources() as sources:
+        data = Odict(read_file(config_path))
+    with exc(OSError):
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmpfile = mkstemp(dir=cache_dir)
+        with os.fdopen(fd, 'wb') as fh:
+            pickle.dump((CACHE_STAMP, sources, data), fh,
+                pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpfile, cache_path)
+    return data
+
+
+class FileCache:
+    '''Memoize file contents and parsed yaml files.
+    By default a cache lives for a single load (see file_cache). With
+    validate=True entries are checked against file mtimes, so the cache can
+    be shared by a whole process. hits and misses count lookups.
+    '''
+    def __init__(self, validate=False):
+        self.validate = validate
+        self.texts = {}
+        self.docs = {}
+        self.hits = self.misses = 0
+
+    def text(self, file_path):
+        '''Return file content or None if it can not be read'''
+        path = abspath(file_path)
+        if self._cached(path):
+            self.hits += 1
+            return self.texts[path][1]
+        self.misses += 1
+        self.texts[path] = _fetch(path)
+        return self.texts[path][1]
+
+    def prefetch(self, paths, workers=PREFETCH_WORKERS):
+        '''Read files not in the cache concurrently, following their
+        !include and !read tags one level at a time. On latency bound file
+        systems (eg: NFS) a load then waits for each level of includes
+        instead of each file. Files are still parsed and merged in order
+        when the load reads them from the cache.
+        '''
+        pending = [abspath(p) for p in paths]
+        pool = None
+        try:
+            while pending:
+                pending = [p for p in dict.fromkeys(pending)
+                    if not self._cached(p)]
+                if len(pending) > 1 and pool is None:
+                    from concurrent.futures import ThreadPoolExecutor
+                    pool = ThreadPoolExecutor(workers)
+                entries = pool.map(_fetch, pending) if pool else map(
+                    _fetch, pending)
+                for path, entry in zip(pending, list(entries)):
+                    self.misses += 1
+                    self.texts[path] = entry
+                pending = [p for path in pending
+                    for p in _source_paths(self.texts[path][1])]
+        finally:
+            if pool:
+                pool.shutdown()
+
+    def _cached(self, path):
+        entry = self.texts.get(path)
+        return entry and (not self.validate or entry[0] == _stat(path))
+
+    def load(self, file_path):
+        '''Return yaml file parsed with Loader. Do not mutate it: the same
+        object is returned while the file and its own sources are unchanged.
+        '''
+        path = abspath(file_path)
+        entry = self.docs.get(path)
+        if entry and (not self.validate or (entry[1].unchanged(env_only=True)
+                and all(_stat(p) == stamp for p, stamp in entry[2].items()))):
+            self.hits += 1
+            sources = _sources.get()
+            if sources is not None:
+                sources.update(entry[1])
+            return entry[0]
+        self.misses += 1
+        with track_sources() as sources:
+            data = yaml.load(read_file(path), Loader)
+        stamps = {p: self.texts[p][0] for p in sources.files
+            if p in self.texts}
+        self.docs[path] = data, sources, stamps
+        return data
+
+
+class Sources:
+    '''Files and envvars read while loading yaml.
+    files maps file paths to content digests (None if unreadable) and env maps
+    envvar names to values (None if unset). checked tells if a checkconfig
+    ran, whose outcome may depend on more than these sources.
+    '''
+    checked = False
+
+    def __init__(self):
+        self.files = {}
+        self.env = {}
+
+    def update(self, sources):
+        '''Add files and envvars from other sources'''
+        self.files.update(sources.files)
+        self.env.update(sources.env)
+        self.checked = self.checked or sources.checked
+
+    def unchanged(self, env_only=False):
+        '''Return True if files and envvars are still the same'''
+        return (all(environ.get(k) == v for k, v in self.env.items()) and
+            (env_only or all(_digest(read_file(path) if isfile(path) else None)
+                == digest for path, digest in self.files.items())))
+
+
+def _stamps(sources, cache):
+    '''Return {path: (mtime, size)} of sources files as read through cache'''
+    texts = cache.texts
+    return {path: texts[path][0] if path in texts else _stat(path)
+        for path in sources.files}
+
+
+@contextmanager
+def file_cache(cache=None):
+    r'''Read and parse each file once within the scope, returning its
+    FileCache. An already active cache is kept, otherwise cache (eg: a process
+    wide FileCache(validate=True)) or a new FileCache is used.
+
+    >>> with tempfile() as fh, file_cache() as cache:
+    ...     _ = fh.write('{db: {host: pg}, cache: {host: redis}}')
+    ...     fh.flush()
+    ...     Odict(f'db: !include {fh.name}:db\n'
+    ...         f'cache: !include {fh.name}:cache')
+    {db: {host: pg}, cache: {host: redis}}
+    >>> cache.hits, cache.misses
+    (1, 2)
+    '''
+    active = _cache.get()
+    if active:
+        yield active
+        return
+    token = _cache.set(cache or FileCache())
+    try:
+        yield _cache.get()
+    finally:
+        _cache.reset(token)
+
+
+@contextmanager
+def track_sources():
+    '''Record files and envvars read by loadconfig in a Sources object
+
+    >>> with track_sources() as sources:
+    ...     _ = Odict('home: !env home')
+    >>> list(sources.env)
+    ['HOME']
+    '''
+    sources = Sources()
+    token = _sources.set(sources)
+    try:
+        yield sources
+    finally:
+        _sources.reset(token)
+        # Nested scopes also record into the outer one
+        if _sources.get() is not None:
+            _sources.get().update(sources)
+
+
+def __getattr__(name):
+    '''Import Run and AsyncRun from loadconfig.process on first use'''
+    if name in ('AsyncRun', 'Run'):
+        from . import process
+        return getattr(process, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
 class Ret(str):
     r'''Return class.
     arg[0] is the string value for the Ret object.
@@ -228,58 +625,14 @@ class Ret(str):
     _r = property(lambda self: self.__dict__)
 
 
-class Run(Popen):
-    r'''Simplify Popen API. Add stop method, asyn parameter and code attrib.
-    stop method and blocking mode (asyn=False) call communicate.
-    After communicate, stdout and stderr are mutated to strings
-
-    >>> from time import sleep
-    >>> with Run('echo hi; sleep 1000000', asyn=True) as proc:
-    ...     sleep(0.2)
-    >>> 'hi\n' == proc.stdout
-    True
-    '''
-    def __init__(self, cmd, asyn=False, **kwargs):
-        kw = dict(kwargs)
-        kw.setdefault('universal_newlines', True)
-        kw.setdefault('stdout', PIPE)
-        kw.setdefault('stderr', PIPE)
-        kw.setdefault('shell', True)
-        kw['preexec_fn'] = os.setsid
-        if not kw['shell'] and isinstance(cmd, (str, str)):
-            cmd = shlex.split(cmd)
-        super(Run, self).__init__(cmd, **kw)
-        if asyn is False:
-            self.get_output()
-
-    def get_output(self):
-        if not isinstance(self.stdout, (str, str)):
-            self.stdout, self.stderr = self.communicate()
-            self.code = self.wait()
-        return self.stdout
-
-    def stop(self):
-        if not self.poll():
-            with exc(OSError):
-                self.send_signal(SIGTERM)
-        self.get_output()
-
-    def send_signal(self, sig):
-        os.killpg(self.pid, sig)
-
-    def __enter__(self):
-        return self
-
-    def __exit__(self, type, value, traceback):
-        self.stop()
-
-
 class run(str):
     r'''Execute command cmd. kwargs are the same as Popen.
     Return object is a string object with extra attributes: stdout, stderr and
-    code (Popen.returncode). Note: run subclasses str for convenience and works
-    well in most cases. In a few corner cases, wrapping run with str, like
-    str(run()), might be needed.
+    code (Popen.returncode). A command still running after timeout seconds is
+    killed, its code being -9 (SIGKILL). With tail, output is streamed and
+    only its last tail characters are kept. Note: run subclasses str for
+    convenience and works well in most cases. In a few corner cases, wrapping
+    run with str, like str(run()), might be needed.
 
     >>> ret = run('echo $((1+1))')
     >>> '2\n' == ret
@@ -287,8 +640,9 @@ class run(str):
     >>> ret.code
     0
     '''
-    def __new__(cls, cmd, **kwargs):
-        proc = Run(cmd, asyn=False, **kwargs)
+    def __new__(cls, cmd, timeout=None, **kwargs):
+        from .process import Run
+        proc = Run(cmd, asyn=False, timeout=timeout, **kwargs)
         ret = super(run, cls).__new__(cls, proc.stdout)
         ret.stdout = proc.stdout
         ret.stderr = proc.stderr
@@ -298,6 +652,37 @@ class run(str):
     _r = property(lambda self: self.__dict__)
 
 
+def run_batch(cmds, workers=8, timeout=None, **kwargs):
+    r'''Run commands concurrently, at most workers at a time. Return their
+    run results in cmds order. timeout applies to each command and kwargs
+    are the same as run.
+
+    >>> rets = run_batch(['echo a', 'echo b >&2; exit 3', 'sleep 10'],
+    ...     timeout=0.5)
+    >>> [(ret.stdout, ret.stderr, ret.code) for ret in rets]
+    [('a\n', '', 0), ('', 'b\n', 3), ('', '', -9)]
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+    cmds = list(cmds)
+    with ThreadPoolExecutor(max(1, min(workers, len(cmds)))) as pool:
+        return list(pool.map(lambda cmd: run(cmd, timeout, **kwargs), cmds))
+
+
+async def arun(cmd, timeout=None, **kwargs):
+    r'''asyncio counterpart of run. Return a Ret of the command stdout with
+    stdout, stderr and code attributes, not blocking the event loop.
+
+    >>> import asyncio
+    >>> ret = asyncio.run(arun('echo $((1+1))'))
+    >>> '2\n' == ret, ret.code
+    (True, 0)
+    '''
+    from .process import AsyncRun
+    proc = await AsyncRun(cmd, timeout=timeout, **kwargs)
+    return Ret(proc.stdout, stdout=proc.stdout, stderr=proc.stderr,
+        code=proc.code)
+
+
 class tempdir(str):
     '''Create temporary directory. Autoremove it if used as context manager.
     Tempdir uses same keyword arguments as tempfile.mkdtemp.
@@ -313,10 +698,12 @@ class tempdir(str):
     True
     '''
     def __new__(cls, *args, **kwargs):
+        from tempfile import mkdtemp
         tmpdir = mkdtemp(**kwargs)
         return super(tempdir, cls).__new__(cls, tmpdir)
 
     def remove(self):
+        from shutil import rmtree
         rmtree(self)
 
     def __enter__(self):
@@ -343,6 +730,7 @@ def tempfile(*args, **kwargs):
     >>> isfile(fh.name)
     False
     '''
+    from tempfile import mkstemp
     tmpfile_fd, tmpfile = mkstemp(**kwargs)
     os.close(tmpfile_fd)
     mode = 'wt+' if kwargs.get('text', True) else 'w+'
@@ -365,51 +753,529 @@ def write_file(file_path, data):
     return not bool(e())
 
 
-def _get_option(option_string):
-    '''Get the value and option letter of an argument
+def _compose(yaml_string):
+    '''Return loader and root node of yaml_string, parsed as Odict does'''
+    yaml_string = dedent(yaml_string)
+    try:
+        loader = Loader(yaml_string)
+        return loader, loader.get_single_node()
+    except yaml.scanner.ScannerError:
+        # Yaml needs {} on multi-key single-line strings
+        loader = Loader(f'{{{yaml_string}}}')
+        return loader, loader.get_single_node()
+
+
+def _copy_tree(data):
+    '''Copy containers in data, sharing scalars.
+    Unlike deepcopy, repeated references (eg: yaml aliases) are copied apart.
+
+    >>> d = Odict('{a: &x {b: [1]}, c: *x}')
+    >>> d2 = _copy_tree(d)
+    >>> d2 == d, d2.a is d.a, d2.a is d2.c, type(d2.a)
+    (True, False, False, <class 'loadconfig.lib.Odict'>)
+    '''
+    if isinstance(data, dict):
+        new = type(data)()
+        dict.update(new, ((k, _copy_tree(v)) for k, v in data.items()))
+        return new
+    if isinstance(data, (list, tuple, set)):
+        return type(data)(_copy_tree(e) for e in data)
+    return data
+
+
+def _digest(data):
+    '''Return sha256 hex digest of a string, None for None'''
+    import hashlib
+    return None if data is None else hashlib.sha256(data.encode()).hexdigest()
+
+
+def _load_file(file_path):
+    '''Return yaml file parsed with Loader, through the active file_cache'''
+    cache = _cache.get()
+    if cache:
+        return cache.load(file_path)
+    return yaml.load(read_file(file_path), Loader)
 
-    >>> _get_option("-C='/data/conf/build.conf'")
-    ('/data/conf/build.conf', 'C')
+
+def _fetch(path):
+    '''Return file (stamp, content) as kept by FileCache'''
+    return _stat(path), _read(path)
+
+
+def _source_paths(yaml_string, args=None):
+    '''Return paths of files read by a yaml string and -C and -E options.
+    Paths depending on $keys are left out.
+
+    >>> _source_paths('a: !include common.yml:a', ['', '-E=b: !read key',
+    ...     '-C=/tmp', '-C=$home/a.yml'])
+    ['common.yml', 'key', '/tmp/config.conf']
     '''
-    assert re.search(r'^-\w', option_string)
-    option = option_string[1]
-    value = (option_string[3:] if option_string[3:4] not in ['"', "'"]
-        else option_string[4:-1])
-    return value, option
+    options = _scan_options(args)[0] if args else []
+    paths = []
+    for string in [yaml_string] + [v for o, v in options if o == 'E']:
+        if isinstance(string, str) and ('!include' in string or
+                '!read' in string):
+            paths += [path.partition(':')[0] if tag == 'include' else path
+                for tag, path in SOURCE_TAG.findall(string) if '$' not in path]
+    for value in [v for o, v in options if o == 'C' and '$' not in v]:
+        paths.append(f'{value}/config.conf' if isdir(value) else value)
+    return paths
+
+
+def _read(file_path):
+    '''Return file content or None if it can not be read'''
+    with exc(IOError), open(file_path) as fh:
+        return str(fh.read())
 
 
-@contextmanager
-def _patch_argparse_clg(args, types):
-    '''Temporarely patch argparse and clg
-
-    Use stderr to print help and version. Allow line breaks on clg.
-    Add custom types to clg. stdout is best used for shell export envvars.
-    Replace help and version exit status by 1 instead of 0.
-    '''
-    def ap_print_message(self, message, file=None):
-        if message and message[-1] == '\n':
-            message = message[:-1]
-        raise SystemExit(message)
-    # argparse_HelpFormatter = argparse.HelpFormatter
-    # # Monkeypatch argparse and clg
-    sys_argv = sys.argv
-    sys.argv[0] = args[0]
-    argparse_HelpFormatter = argparse.HelpFormatter
-    argparse.HelpFormatter = argparse.RawTextHelpFormatter
-    argparse_print_message = argparse.ArgumentParser._print_message
-    argparse.ArgumentParser._print_message = ap_print_message
-    TYPES = clg.TYPES
-    # clg expects a dictionary with function names as keys
-    types = {e.__name__: e for e in types}
-    clg.TYPES.update(types)
+def _stat(file_path):
+    '''Return file (mtime, size) or None if it does not exist'''
+    with exc(OSError) as e:
+        st = os.stat(file_path)
+    return None if e() else (st.st_mtime_ns, st.st_size)
+
+
+def _dollar(value):
+    '''Return True if some string in value has a $
+
+    >>> _dollar({'a': ['$b']}), _dollar({'a': 1})
+    (True, False)
+    '''
+    if isinstance(value, str):
+        return '$' in value
+    if isinstance(value, dict):
+        return any(_dollar(k) or _dollar(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return any(_dollar(e) for e in value)
+    return False
+
+
+def _export_words(value):
+    '''Return (string, words) for an exported config value.
+    Lists are flattened into words, quoted as shell words in string.
+    words is None for scalars and mappings.
+    '''
+    value = '' if value is None else value
+    if isinstance(value, (list, tuple)):
+        import shlex
+        words = [repr(e) if isinstance(e, dict) else str(e)
+            for e in flatten(value)]
+        return ' '.join(map(shlex.quote, words)), words
+    if isinstance(value, dict):
+        return repr(value), None
+    return str(value), None
+
+
+def _fish_quote(string):
+    return "'{}'".format(string.replace('\\', '\\\\').replace("'", "\\'"))
+
+
+def _dotenv_quote(string):
+    for char, escaped in (('\\', '\\\\'), ('"', '\\"'), ('$', '\\$'),
+            ('\n', '\\n')):
+        string = string.replace(char, escaped)
+    return '"{}"'.format(string)
+
+
+# Export line formats by dialect. sh values are left unquoted to let the
+# shell expand them, as loadconfig output is meant to be eval'ed.
+EXPORT_DIALECTS = {
+    'sh': lambda name, string, words: f'export {name}="{string}"\n',
+    'bash': lambda name, string, words: f'{name}=({string})\n'
+        if words is not None else f'export {name}="{string}"\n',
+    'fish': lambda name, string, words: 'set -gx {}\n'.format(' '.join([name]
+        + list(map(_fish_quote, [string] if words is None else words)))),
+    'dotenv': lambda name, string, words: f'{name}={_dotenv_quote(string)}\n',
+    'env0': lambda name, string, words: f'{name}={string}\0',
+}
+
+
+def _scan_options(args):
+    '''Split cli arguments into -E/-C config options and the rest in a pass.
+    Accept -C=file, -C file, --conf=file, --conf file and likewise -E/--str.
+    Options are returned as (letter, value) with surrounding quotes removed.
+    Arguments after -- are left to clg.
+
+    >>> _scan_options(['build', "-C='/data/build.conf'", '--str', 'a: 1', 'x'])
+    ([('C', '/data/build.conf'), ('E', 'a: 1')], ['build', 'x'])
+    '''
+    options, rest = [], []
+    it = iter(args)
+    for arg in it:
+        match = OPTION_ARG.match(arg) if isinstance(arg, str) else None
+        if match is None:
+            rest.append(arg)
+            if arg == '--':
+                rest.extend(it)
+            continue
+        letter, value = match.group(1) or OPTION_NAMES[match.group(2)], \
+            match.group(3)
+        if value is None:
+            value = next(it, None)
+            if value is None:
+                rest.append(arg)
+                break
+        elif value[:1] in ('"', "'"):
+            value = value[1:-1]
+        options.append((letter, value))
+    return options, rest
+
+
+class _Pending:
+    '''Placeholder of a LazyConfig value to be constructed and interpolated.
+    node is constructed with loader on first access, otherwise value is used.
+    refs are the $keys it references and dollar tells if it has any $.
+    '''
+    __slots__ = ('loader', 'node', 'value', 'refs', 'dollar')
+
+    def __init__(self, value=None, loader=None, node=None, refs=None,
+            dollar=None):
+        self.value, self.loader, self.node = value, loader, node
+        self.refs = set(_refs(value)) if refs is None else refs
+        self.dollar = _dollar(value) if dollar is None else dollar
+
+    def construct(self):
+        if self.node is not None:
+            self.value = self.loader.construct_object(self.node, deep=True)
+            self.loader = self.node = None
+        return self.value
+
+
+def _refs(value):
+    '''Yield $key names referenced from value
+
+    >>> sorted(_refs({'a': '$b', 'c': ['${d}.txt', 1, '$$e']}))
+    ['b', 'd']
+    '''
+    if isinstance(value, str):
+        if '$' in value:
+            for mo in Template.pattern.finditer(value):
+                if mo.group('named') or mo.group('braced'):
+                    yield mo.group('named') or mo.group('braced')
+    elif isinstance(value, dict):
+        for k, v in value.items():
+            yield from _refs(k)
+            yield from _refs(v)
+    elif isinstance(value, (list, tuple)):
+        for e in value:
+            yield from _refs(e)
+
+
+def _render(value, mapping):
+    '''Return value with $keys substituted from mapping.
+    Containers are copied only when some of their elements change.
+
+    >>> _render({'a': ['$b', 'c'], 'd': '$e'}, {'b': 1, 'e': {'f': 2}})
+    {'a': [1, 'c'], 'd': {'f': 2}}
+    '''
+    if isinstance(value, str):
+        if '$' not in value:
+            return value
+        mo = Template.pattern.fullmatch(value)
+        key = mo and (mo.group('named') or mo.group('braced'))
+        if key in mapping and not isinstance(mapping[key], str):
+            return _copy_tree(mapping[key])
+        string = Template(value).safe_substitute(mapping)
+        return value if string == value else _scalar(string)
+    if isinstance(value, dict):
+        items = [(_render(k, mapping), _render(v, mapping))
+            for k, v in value.items()]
+        if all(k is k0 and v is v0
+               for (k, v), (k0, v0) in zip(items, value.items())):
+            return value
+        new = type(value)()
+        dict.update(new, items)
+        return new
+    if isinstance(value, (list, tuple)):
+        elements = [_render(e, mapping) for e in value]
+        if all(e is e0 for e, e0 in zip(elements, value)):
+            return value
+        return type(value)(elements)
+    return value
+
+
+def _scan_node(node):
+    '''Return $key refs, if there is any $ and if there are custom tags
+    on a yaml node tree
+
+    >>> loader, node = _compose('a: [$b, !env c]')
+    >>> _scan_node(node)
+    ({'b'}, True, True)
+    '''
+    refs, dollar, tagged = set(), False, False
+    stack, seen = [node], set()
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        tagged = tagged or node.tag.startswith('!')
+        if isinstance(node, yaml.ScalarNode):
+            if '$' in node.value:
+                dollar = True
+                refs.update(_refs(node.value))
+        elif isinstance(node, yaml.SequenceNode):
+            stack.extend(node.value)
+        else:
+            for key_node, value_node in node.value:
+                stack += [key_node, value_node]
+    return refs, dollar, tagged
+
+
+def _scalar(string):
+    '''Type a single line string as a plain yaml scalar would be
+
+    >>> _scalar('3'), _scalar('3.1'), _scalar('true'), _scalar('3 km')
+    (3, 3.1, True, '3 km')
+    '''
+    if '\n' in string:
+        return string
+    tag = _resolver.resolve(yaml.ScalarNode, string, (True, False))
+    if tag in (STR_TAG, MERGE_TAG, VALUE_TAG):
+        return string
+    return yaml.safe_load(string)
+
+
+def _check_code(source, cache_dir=''):
+    '''Return checkconfig source compiled once per process. With cache_dir
+    code objects are also kept there, per python version.
+
+    >>> _check_code('x = 1') is _check_code('x = 1')
+    True
+    '''
+    key = _digest(f'{sys.implementation.cache_tag}\0{source}')
+    with _checks_lock:
+        code = CHECK_CODES.pop(key, None)
+        if code is None:
+            code = _cached_code(source, key, cache_dir) if cache_dir else \
+                compile(source, '<checkconfig>', 'exec')
+            if len(CHECK_CODES) >= CHECKS_MAX:
+                del CHECK_CODES[next(iter(CHECK_CODES))]
+        CHECK_CODES[key] = code
+    return code
+
+
+def _cached_code(source, key, cache_dir):
+    '''Return code object compiled from source, persisted on cache_dir'''
+    import marshal
+    from tempfile import mkstemp
+    cache_path = f'{cache_dir}/{key}.checkconfig'
+    with exc(Exception), open(cache_path, 'rb') as fh:
+        return marshal.load(fh)
+    code = compile(source, '<checkconfig>', 'exec')
+    with exc(OSError):
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmpfile = mkstemp(dir=cache_dir)
+        with os.fdopen(fd, 'wb') as fh:
+            marshal.dump(code, fh)
+        os.replace(tmpfile, cache_path)
+        # Keep the CHECKS_MAX newest code objects
+        paths = [entry.path for entry in os.scandir(cache_dir)
+            if entry.name.endswith('.checkconfig')]
+        for path in sorted(paths, key=getmtime)[:-CHECKS_MAX]:
+            os.remove(path)
+    return code
+
+
+def _schema_validator(schema, types=()):
+    '''Return checkschema validator function, compiled once per schema and
+    custom types
+    '''
+    import json
+    key = _digest(json.dumps(schema, default=repr)), tuple(types)
+    with _checks_lock:
+        validator = SCHEMAS.pop(key, None)
+        if validator is None:
+            if not isinstance(schema, dict):
+                raise ValueError('Invalid checkschema: {} is not a map of '
+                    'keys to specs'.format(Odict.dump(schema)))
+            validator = _compile_spec({'type': 'map', 'keys': schema},
+                {f.__name__: f for f in types})
+            if len(SCHEMAS) >= CHECKS_MAX:
+                del SCHEMAS[next(iter(SCHEMAS))]
+        SCHEMAS[key] = validator
+    return validator
+
+
+def _compile_spec(spec, custom, spec_path=''):
+    '''Return function(value, path, errors) checking value against a
+    checkschema spec, appending (path, error) pairs to errors and returning
+    the coerced value. custom maps type names to their functions. Raise
+    ValueError on malformed specs.
+
+    >>> _compile_spec({'min': 'one'}, {}, 'port')
+    Traceback (most recent call last):
+        ...
+    ValueError: Invalid checkschema spec port: min one is not int or float
+    '''
+    show = Odict.dump
+
+    def invalid(error):
+        return ValueError(f'Invalid checkschema spec {spec_path}: {error}')
+    if not isinstance(spec, dict):
+        spec = {'type': spec}
+    for option, value in spec.items():
+        if option not in SCHEMA_OPTIONS:
+            raise invalid(f'unknown option {show(option)}')
+        types = SCHEMA_OPTIONS[option]
+        if not isinstance(value, types) or isinstance(value, bool) and \
+                option in ('min', 'max'):
+            raise invalid('{} {} is not {}'.format(option, show(value),
+                ' or '.join(t.__name__ for t in (types if isinstance(types,
+                tuple) else [types]))))
+    name = spec.get('type', 'map' if 'keys' in spec else
+        'list' if 'items' in spec else 'any')
+    if name not in SCHEMA_TYPES and name not in custom:
+        raise ValueError(f'Unknown checkschema type {name}')
+    convert = custom.get(name)
+    types, choices = SCHEMA_TYPES.get(name, object), spec.get('choices')
+    minimum, maximum = spec.get('min'), spec.get('max')
     try:
-        yield
-    finally:
-        # Un-monkeypatch argparse and clg
-        clg.TYPES = TYPES
-        argparse.HelpFormatter = argparse_HelpFormatter
-        argparse.ArgumentParser._print_message = argparse_print_message
-        sys.argv = sys_argv
+        match = re.compile(spec['match']) if 'match' in spec else None
+    except re.error as e:
+        raise invalid(f'match {e}') from None
+    keys = [(key, bool(sub.get('required')) if isinstance(sub, dict) else
+        False, isinstance(sub, dict) and 'default' in sub,
+        sub.get('default') if isinstance(sub, dict) else None,
+        _compile_spec(sub, custom, f'{spec_path}:{key}' if spec_path
+        else str(key)))
+        for key, sub in (spec.get('keys') or {}).items()]
+    items = _compile_spec(spec['items'], custom, f'{spec_path}:items') \
+        if 'items' in spec else None
+
+    def check(value, path, errors):
+        if convert:
+            try:
+                value = convert(value)
+            except (TypeError, ValueError) as e:
+                errors.append((path, f'{show(value)} is not {name}: {e}'))
+                return value
+        elif isinstance(value, str) and name in ('bool', 'float', 'int'):
+            value = _scalar(value)
+        if name == 'float' and isinstance(value, int) and \
+                not isinstance(value, bool):
+            value = float(value)
+        if not isinstance(value, types) or isinstance(value, bool) and \
+                name in ('int', 'float'):
+            errors.append((path, f'{show(value)} is not {name}'))
+            return value
+        if choices is not None and value not in choices:
+            errors.append((path, f'{show(value)} is not one of '
+                f'{show(choices)}'))
+        if minimum is not None or maximum is not None:
+            if isinstance(value, (str, list, dict)):
+                size = len(value)
+            elif isinstance(value, (int, float)) and \
+                    not isinstance(value, bool):
+                size = value
+            else:
+                size = None
+                errors.append((path, f'{show(value)} has no size for min '
+                    'or max'))
+            if size is not None and minimum is not None and size < minimum:
+                errors.append((path, f'{show(value)} is below min {minimum}'))
+            if size is not None and maximum is not None and size > maximum:
+                errors.append((path, f'{show(value)} is above max {maximum}'))
+        if match and not match.search(str(value)):
+            errors.append((path, f'{show(value)} does not match '
+                f'{match.pattern}'))
+        if keys and not isinstance(value, dict):
+            errors.append((path, f'{show(value)} is not map'))
+        elif keys:
+            for key, required, has_default, default, check_key in keys:
+                key_path = f'{path}:{key}' if path else str(key)
+                if key in value:
+                    new = check_key(value[key], key_path, errors)
+                    if new is not value[key]:
+                        value[key] = new
+                elif has_default:
+                    value[key] = check_key(_copy_tree(default), key_path,
+                        errors)
+                elif required:
+                    errors.append((key_path, 'required key is missing'))
+        if items and not isinstance(value, list):
+            errors.append((path, f'{show(value)} is not list'))
+        elif items:
+            for i, element in enumerate(value):
+                new = items(element, f'{path}:{i}', errors)
+                if new is not element:
+                    value[i] = new
+        return value
+    return check
+
+
+def _clg_spec(clg_key, prog, names):
+    '''Return a copy of clg_key building a parser with no global patching.
+    Help keeps line breaks, prog defaults to the program name and custom
+    types are renamed as in names, their names while the parser is built.
+
+    >>> spec = _clg_spec({'args': {'path': {'type': 'basename'}}}, 'prog',
+    ...     {'basename': 'basename@1'})
+    >>> spec['prog'], spec['formatter_class'], spec['args']['path']['type']
+    ('prog', 'RawTextHelpFormatter', 'basename@1')
+    '''
+    spec = _copy_tree(clg_key)
+    if prog:
+        spec.setdefault('prog', prog)
+    parsers, groups = [spec], []
+    while parsers:
+        conf = parsers.pop()
+        conf.setdefault('formatter_class', 'RawTextHelpFormatter')
+        groups.append(conf)
+        groups += conf.get('groups', []) + conf.get('exclusive_groups', [])
+        subparsers = conf.get('subparsers') or {}
+        parsers.extend(subparsers.get('parsers', subparsers).values())
+    for conf in groups:
+        for arg_conf in [*(conf.get('options') or {}).values(),
+                         *(conf.get('args') or {}).values()]:
+            if isinstance(arg_conf, dict) and arg_conf.get('type') in names:
+                arg_conf['type'] = names[arg_conf['type']]
+    return spec
+
+
+def _print_message(message, file=None):
+    '''argparse parsers message handler. Raise help, version and usage
+    messages as SystemExit: stdout is best used for shell export envvars
+    and help and version exit status is 1 instead of 0.
+    '''
+    if message and message[-1] == '\n':
+        message = message[:-1]
+    raise SystemExit(message)
+
+
+def _clg_parser(clg_key, args, types):
+    '''Return clg.CommandLine for clg_key, compiled once per spec.
+    Parsers are keyed on a digest of the spec, the program name and the
+    custom types, as clg resolves types and argparse the program name when
+    the parser is built. Custom types are only in clg.TYPES while building,
+    under a name unique to each function. Built parsers are not mutated, so
+    they can be shared by threads.
+    '''
+    import argparse
+    import clg
+    import json
+    spec = json.dumps(clg_key, default=repr)
+    key = (_digest(spec), basename(args[0]), tuple(types))
+    with _clg_lock:
+        cmd = CLG_PARSERS.pop(key, None)
+        if cmd is None:
+            names = {}
+            for f in types:
+                names[f.__name__] = name = f'{f.__name__}@{id(f):x}'
+                clg.TYPES[name] = f
+            try:
+                cmd = clg.CommandLine(_clg_spec(clg_key, basename(args[0]),
+                    names), deepcopy=False)
+            finally:
+                for name in names.values():
+                    clg.TYPES.pop(name, None)
+            for parser in cmd._parsers.values():
+                if isinstance(parser, argparse.ArgumentParser):
+                    parser._print_message = _print_message
+            if len(CLG_PARSERS) >= CLG_PARSERS_MAX:
+                del CLG_PARSERS[next(iter(CLG_PARSERS))]
+        CLG_PARSERS[key] = cmd
+    return cmd
 
 
 def _clg_parse(clg_key, args, types):
@@ -420,18 +1286,22 @@ def _clg_parse(clg_key, args, types):
     if 'default_cmd' in clg_key:
         default_cmd = clg_key['default_cmd']
         del clg_key['default_cmd']
-    with _patch_argparse_clg(args, types), exc(SystemExit) as e:
-        clg_args = clg.CommandLine(deepcopy(clg_key)).parse(args[1:])
+    cmd = _clg_parser(clg_key, args, types)
+    with exc(SystemExit) as e:
+        clg_args = cmd.parse(args[1:])
     if e() and hasattr(e(), 'code') and e().code.startswith('usage:') and \
      'default_cmd' in locals() and '-h' not in args and '--help' not in args:
-        # Try clg parsing once more with default_cmd
+        # Try clg parsing once more with default_cmd on the same parser
         new_args = [default_cmd] + args[1:]
-        with _patch_argparse_clg(args, types), exc(SystemExit) as e:
-            clg_args = clg.CommandLine(deepcopy(clg_key)).parse(new_args)
+        with exc(SystemExit) as e:
+            clg_args = cmd.parse(new_args)
         if e():
             raise e()
     elif e():
         raise e()
+    # Cached parsers hand the same default objects to every parse
+    for key, value in vars(clg_args).items():
+        setattr(clg_args, key, _copy_tree(value))
     return clg_args
 
 
@@ -513,6 +1383,17 @@ class Odict(dict):
         '''
         self[name] = value
 
+    def __setstate__(self, state):
+        '''Restore pickled instance state, not looked up through __getattr__
+
+        >>> import pickle
+        >>> d = Odict('a: 1')
+        >>> d.__dict__['_source'] = 'a.yml'
+        >>> pickle.loads(pickle.dumps(d)).__dict__
+        {'_source': 'a.yml'}
+        '''
+        self.__dict__.update(state)
+
     def __str__(self):
         return Odict.dump(self, False)
 
@@ -534,80 +1415,165 @@ class Odict(dict):
     def dump(yaml_string, default_flow_style=True):
         '''Serialize odict into yaml string'''
         stream = StringIO()
-        yaml.dump(yaml_string, stream, Dumper,
+        # libyaml indents block sequences differently. Use it for flow only
+        dumper = Dumper if default_flow_style is True else PyDumper
+        yaml.dump(yaml_string, stream, dumper,
             default_flow_style=default_flow_style)
         return stream.getvalue()[:-1]
 
 
-class Loader(yaml.SafeLoader):
+class _Loader:
+    '''Add loadconfig tags and Odict mappings to a yaml safe loader'''
+    def __init_subclass__(cls, **kwargs):
+        # Constructors are called as function(loader, node). Registering
+        # plain functions once per class keeps loaders in threads apart
+        super().__init_subclass__(**kwargs)
+        cls.add_constructor(MAPPING_TAG, cls.odict_mapping)
+        cls.add_constructor('!env', cls.env)
+        cls.add_constructor('!read', cls.read)
+        cls.add_constructor('!include', cls.include)
+        cls.add_constructor('!expand', cls.expand)
+
     def __init__(self, yaml_string):
         self._root = ''
         yaml_string = self.pre_include(yaml_string)
         super().__init__(yaml_string)
-        self.add_constructor(MAPPING_TAG, self.odict_mapping)
-        self.add_constructor('!env', self.env)
-        self.add_constructor('!read', self.read)
-        self.add_constructor('!include', self.include)
-        self.add_constructor('!expand', self.expand)
 
-    def env(self, safeloader, node):
+    def env(self, node):
         node = self.construct_scalar(node)
+        sources = _sources.get()
+        if sources is not None:
+            sources.env[node.upper()] = environ.get(node.upper())
         if node.upper() in environ:
             return {node: environ[node.upper()]}
         return {node: ''}
 
-    def read(self, safeloader, node):
+    def read(self, node):
         node = self.construct_scalar(node)
         return read_file(node)
 
     def pre_include(self, yaml_string):
-        '''Replace non-annotated !include with file content'''
-        # Try up to max times to expand include
-        include_max = 100
-        n = count()
-        while (mo:=re.search(r'^(!include ["\']?([\w/.]+)["\']?)\s*$',
-               yaml_string, flags=re.MULTILINE)) and next(n) < include_max:
-            content = read_file(mo.group(2)).rstrip('\n')
-            yaml_string = re.sub(r'(!include ["\']?[\w/.]+["\']?)\s*$',
-                content, yaml_string, flags=re.MULTILINE)
-        return yaml_string
-
-    def include(self, safeloader, node):
+        '''Replace non-annotated !include lines with file content.
+        Nested includes are spliced in the same single pass over the lines
+        and each file is read once. source_map has a (line, file, file_line)
+        entry for each run of lines coming from the same file.
+        Raise ValueError on cyclic includes.
+        '''
+        self.source_map = [(1, '<string>', 1)]
+        if '!include' not in yaml_string:
+            return yaml_string
+        lines, contents = [], {}
+
+        def splice(text, source, stack):
+            for n, line in enumerate(text.split('\n'), 1):
+                mo = INCLUDE_LINE.match(line)
+                if not mo:
+                    lines.append(line)
+                    continue
+                filepath = mo.group(1)
+                if abspath(filepath) in stack:
+                    raise ValueError('Cyclic !include: {} -> {}'.format(
+                        source, filepath))
+                if filepath not in contents:
+                    contents[filepath] = read_file(filepath).rstrip('\n')
+                self.source_map.append((len(lines) + 1, filepath, 1))
+                splice(contents[filepath], filepath,
+                    stack + [abspath(filepath)])
+                self.source_map.append((len(lines) + 1, source, n + 1))
+
+        splice(yaml_string, '<string>', [])
+        return '\n'.join(lines)
+
+    def source(self, line):
+        '''Return (file, line) where a pre-included yaml line came from
+
+        >>> loader = Loader('a: 1')
+        >>> loader.source(1)
+        ('<string>', 1)
+        '''
+        start, source, source_line = self.source_map[
+            bisect_right(self.source_map, line, key=itemgetter(0)) - 1]
+        return source, source_line + line - start
+
+    def include(self, node):
         node = self.construct_scalar(node)
         filepath, sep, key = node.partition(':')
-        self._root = yaml.load(read_file(filepath), Loader)
+        self._root = _load_file(filepath)
         return self.subkey(key)
 
-    def expand(self, safeloader, node):
+    def expand(self, node):
         key = self.construct_scalar(node)
-        self._root = safeloader._root
         return self.subkey(key)
 
     def subkey(self, key):
-        if not self._root:
-            return ''
-        data = deepcopy(self._root)
-        if key == '&':
+        '''Return a copy of the _root subtree at colon separated key.
+        _root may be shared through file_cache, so only the subtree is copied.
+        '''
+        if not self._root or key == '&':
             return ''
+        data = self._root
         for k in key.split(':'):
             if not k:
-                return data
+                break
             data = data.get(k)
             if data is None:
                 return ''
-        return data
+        return _copy_tree(data)
 
-    def odict_mapping(self, safeloader, node):
-        safeloader.flatten_mapping(node)
-        return Odict(safeloader.construct_pairs(node))
+    def odict_mapping(self, node):
+        self.flatten_mapping(node)
+        return Odict(self.construct_pairs(node))
 
 
-class Dumper(yaml.SafeDumper):
+class _Dumper:
+    '''Represent Odict and never emit aliases on a yaml safe dumper'''
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.ignore_aliases = lambda self: True
         self.add_representer(Odict, lambda self, data:
             self.represent_dict(data.items()))
 
+
+class PyLoader(_Loader, yaml.SafeLoader):
+    pass
+
+
+class PyDumper(_Dumper, yaml.SafeDumper):
     def increase_indent(self, flow=False, indentless=False):
         return super().increase_indent(flow, False)
+
+
+CLoader = CDumper = None
+if yaml.__with_libyaml__:
+    class CLoader(_Loader, yaml.CSafeLoader):
+        pass
+
+    class CDumper(_Dumper, yaml.CSafeDumper):
+        pass
+
+
+def yaml_backend(backend=None):
+    '''Return the yaml backend in use, switching to backend if given.
+    backend is libyaml (PyYAML C parser and emitter) or python. libyaml falls
+    back to python if PyYAML was built without it. The initial backend is
+    libyaml unless LOADCONFIG_YAML envvar is set to python.
+
+    >>> backend = yaml_backend()
+    >>> yaml_backend('python')
+    'python'
+    >>> Odict('a: [1, 2]')
+    {a: [1, 2]}
+    >>> _ = yaml_backend(backend)
+    '''
+    global Loader, Dumper
+    if backend:
+        assert backend in ('libyaml', 'python'), \
+            'Unknown yaml backend {}'.format(backend)
+        if backend == 'libyaml' and CLoader:
+            Loader, Dumper = CLoader, CDumper
+        else:
+            Loader, Dumper = PyLoader, PyDumper
+    return 'libyaml' if Loader is CLoader else 'python'
+
+
+yaml_backend(environ.get('LOADCONFIG_YAML', 'libyaml'))
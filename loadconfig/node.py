@@ -0,0 +1,203 @@
+'''Compact read only config trees.
+
+ConfigNode is a frozen, hashable mapping with the key and attribute access of
+Odict, taking a fraction of its memory. Nodes with the same keys share a
+single key table, so generated configs with many small mappings of the same
+shape (eg: host inventories) keep one copy of their keys. Values are kept in
+a tuple, lists become tuples and sets frozensets. Nodes can be shared by
+threads without copies: set and update return new nodes sharing unchanged
+subtrees.
+
+>>> from loadconfig import Odict
+>>> hosts = compact(Odict("""
+...     web1: {ip: 10.0.0.1, port: 80}
+...     web2: {ip: 10.0.0.2, port: 80, tags: [front]}"""))
+>>> hosts.web2.ip, hosts['web1']['port'], hosts.web2.tags
+('10.0.0.2', 80, ('front',))
+>>> hosts
+{web1: {ip: 10.0.0.1, port: 80}, web2: {ip: 10.0.0.2, port: 80, tags: [front]}}
+>>> hosts == thaw(hosts)
+True
+'''
+__all__ = ['ConfigNode', 'compact', 'thaw']
+
+from collections.abc import Mapping
+from .lib import Odict
+from weakref import WeakValueDictionary
+
+
+class _Shape(dict):
+    '''Key to value index table shared by nodes having the same keys'''
+    __slots__ = ('__weakref__',)
+
+    def __reduce__(self):
+        # Pickled once per pickle, then referenced by its nodes
+        return _shape, (tuple(self),)
+
+
+# Key tables in use, by keys and their types (1 == True, but differ as keys)
+_shapes = WeakValueDictionary()
+
+
+def _shape(keys):
+    '''Return the shared key table for a tuple of keys'''
+    key = keys, tuple(map(type, keys))
+    shape = _shapes.get(key)
+    if shape is None:
+        shape = _shapes[key] = _Shape(zip(keys, range(len(keys))))
+    return shape
+
+
+class ConfigNode(Mapping):
+    '''Frozen, hashable mapping with Odict key and attribute access.
+    Missing keys read as None attributes. Keys named as methods, slots or the
+    _r, _s and _p shortcuts are only reachable as items. set and update
+    return new nodes sharing unchanged subtrees with this one.
+
+    >>> node = ConfigNode({'db': {'host': 'pg'}, 'hosts': ['a', 'b']})
+    >>> node.db.host, node['hosts'], node.port
+    ('pg', ('a', 'b'), None)
+    >>> node.port = 5432
+    Traceback (most recent call last):
+    TypeError: ConfigNode is read only
+    '''
+    __slots__ = ('_shape', '_values', '_hash')
+
+    def __init__(self, *args, **kwargs):
+        data = args[0] if len(args) == 1 and not kwargs and isinstance(
+            args[0], dict) else dict(*args, **kwargs)
+        self._init(_shape(tuple(data)), tuple(map(compact, data.values())))
+
+    def _init(self, shape, values):
+        object.__setattr__(self, '_shape', shape)
+        object.__setattr__(self, '_values', values)
+        object.__setattr__(self, '_hash', None)
+        return self
+
+    def set(self, path, value):
+        '''Return a new node with value at a colon separated path of keys
+        (or a sequence of keys), creating missing mappings on the way. Only
+        the nodes along the path are copied.
+
+        >>> node = ConfigNode({'db': {'host': 'pg'}, 'app': {'workers': 4}})
+        >>> new = node.set('db:host', 'mysql')
+        >>> new.db.host, node.db.host, new.app is node.app
+        ('mysql', 'pg', True)
+        >>> node.set(['cache', 'host'], 'redis').cache
+        {host: redis}
+        '''
+        keys = path.split(':') if isinstance(path, str) else list(path)
+        return self._set(keys, compact(value))
+
+    def _set(self, keys, value):
+        key = keys[0]
+        if len(keys) > 1:
+            child = self.get(key)
+            if not isinstance(child, ConfigNode):
+                child = ConfigNode()
+            value = child._set(keys[1:], value)
+        new = object.__new__(type(self))
+        index = self._shape.get(key)
+        if index is None:
+            return new._init(_shape((*self._shape, key)),
+                (*self._values, value))
+        return new._init(self._shape, (*self._values[:index], value,
+            *self._values[index + 1:]))
+
+    def update(self, *args, **kwargs):
+        '''Return a new node with the keys of a mapping or yaml string
+        replaced or added, sharing the other values
+
+        >>> ConfigNode({'a': 1, 'b': 2}).update('b: 3')
+        {a: 1, b: 3}
+        '''
+        data = dict(zip(self._shape, self._values))
+        data.update(Odict(*args, **kwargs))
+        return type(self)(data)
+
+    def __getitem__(self, key):
+        return self._values[self._shape[key]]
+
+    def __getattr__(self, name):
+        if name in ConfigNode.__slots__:
+            raise AttributeError(name)
+        index = self._shape.get(name)
+        if index is not None:
+            return self._values[index]
+
+    def __contains__(self, key):
+        return key in self._shape
+
+    def __iter__(self):
+        return iter(self._shape)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __eq__(self, other):
+        '''Compare equal to nodes with equal items and to their thawed Odict'''
+        if isinstance(other, ConfigNode):
+            return dict(zip(self._shape, self._values)) == dict(
+                zip(other._shape, other._values))
+        if isinstance(other, Mapping):
+            return thaw(self) == other
+        return NotImplemented
+
+    def __hash__(self):
+        if self._hash is None:
+            object.__setattr__(self, '_hash', hash(frozenset(
+                zip(self._shape, self._values))))
+        return self._hash
+
+    def _read_only(self, *args):
+        raise TypeError(f'{type(self).__name__} is read only')
+
+    __setattr__ = __delattr__ = __setitem__ = __delitem__ = _read_only
+
+    def __reduce__(self):
+        return _node, (type(self), self._shape, self._values)
+
+    def __str__(self):
+        return Odict.dump(thaw(self), False)
+
+    def __repr__(self):
+        return Odict.dump(thaw(self))
+
+    # Convenient shortcuts
+    _r = property(__repr__)
+    _s = property(__str__)
+    _p = property(lambda x: print(str(x)))
+
+
+def _node(cls, shape, values):
+    '''Return a cls node of already compact values, as unpickled'''
+    return object.__new__(cls)._init(shape, values)
+
+
+def compact(value):
+    '''Return value with mappings as ConfigNode, lists as tuples and sets as
+    frozensets
+    '''
+    if isinstance(value, dict):
+        return ConfigNode(value)
+    if isinstance(value, (list, tuple)):
+        return tuple(map(compact, value))
+    if isinstance(value, (set, frozenset)):
+        return frozenset(map(compact, value))
+    return value
+
+
+def thaw(value):
+    '''Return value with ConfigNodes as Odict, tuples as lists and
+    frozensets as sets
+
+    >>> thaw(ConfigNode(hosts=['a', 'b']))
+    {hosts: [a, b]}
+    '''
+    if isinstance(value, Mapping):
+        return Odict((k, thaw(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [thaw(e) for e in value]
+    if isinstance(value, (set, frozenset)):
+        return {thaw(e) for e in value}
+    return value
@@ -0,0 +1,246 @@
+'''loadconfig subprocess helpers
+
+Kept apart from lib to only import subprocess (and asyncio for AsyncRun) when
+commands are run.
+'''
+__all__ = ['AsyncRun', 'Run']
+
+from collections import deque
+from .lib import exc
+import os
+import shlex
+from signal import SIGKILL, SIGTERM
+from subprocess import Popen, PIPE, TimeoutExpired
+from time import monotonic
+
+# Characters (or bytes) of stdout and stderr kept by default when streaming
+TAIL = 65536
+
+
+class Run(Popen):
+    r'''Simplify Popen API. Add stop method, asyn parameter and code attrib.
+    stop method and blocking mode (asyn=False) call communicate.
+    After communicate, stdout and stderr are mutated to strings. Commands
+    still running after timeout seconds are killed with their process group.
+    Commands start in a new session without preexec_fn, letting Popen use
+    its faster vfork path. With tail, output is streamed instead of
+    buffered, stdout and stderr keeping only their last tail characters.
+
+    >>> from time import sleep
+    >>> with Run('echo hi; sleep 1000000', asyn=True) as proc:
+    ...     sleep(0.2)
+    >>> 'hi\n' == proc.stdout
+    True
+    >>> Run('seq 100000', tail=13).stdout
+    '99999\n100000\n'
+    '''
+    def __init__(self, cmd, asyn=False, timeout=None, tail=None, **kwargs):
+        self.tail = tail
+        kw = dict(kwargs)
+        kw.setdefault('universal_newlines', True)
+        kw.setdefault('stdout', PIPE)
+        kw.setdefault('stderr', PIPE)
+        kw.setdefault('shell', True)
+        kw['start_new_session'] = True
+        if not kw['shell'] and isinstance(cmd, (str, str)):
+            cmd = shlex.split(cmd)
+        super(Run, self).__init__(cmd, **kw)
+        if asyn is False:
+            self.get_output(timeout)
+
+    def get_output(self, timeout=None):
+        if self.tail and not isinstance(self.stdout, (str, str)):
+            for _ in self.chunks(self.tail, timeout):
+                pass
+        if not isinstance(self.stdout, (str, str)):
+            try:
+                self.stdout, self.stderr = self.communicate(timeout=timeout)
+            except TimeoutExpired:
+                with exc(OSError):
+                    self.send_signal(SIGKILL)
+                self.stdout, self.stderr = self.communicate()
+            self.code = self.wait()
+        return self.stdout
+
+    def chunks(self, tail=TAIL, timeout=None):
+        r'''Yield ('stdout' or 'stderr', chunk) pairs as the command writes
+        them. Once done, stdout and stderr keep their last tail characters
+        and code is set. The command is killed after timeout seconds.
+
+        >>> proc = Run('echo hi; echo ho >&2', asyn=True)
+        >>> sorted(proc.chunks())
+        [('stderr', 'ho\n'), ('stdout', 'hi\n')]
+        >>> proc.code
+        0
+        '''
+        import codecs
+        from io import IncrementalNewlineDecoder
+        import locale
+        import selectors
+        if self.stdin:
+            with exc(OSError):
+                self.stdin.close()
+        empty = '' if self.text_mode else b''
+        pipes = {name: getattr(self, name) for name in ('stdout', 'stderr')
+            if getattr(self, name) is not None}
+        kept = {name: (deque(), [0]) for name in pipes}
+        deadline = timeout and monotonic() + timeout
+        with selectors.DefaultSelector() as selector:
+            for name, pipe in pipes.items():
+                decoder = self.text_mode and IncrementalNewlineDecoder(
+                    codecs.getincrementaldecoder(self.encoding or
+                    locale.getpreferredencoding(False))(self.errors or
+                    'strict'), translate=True)
+                selector.register(pipe.fileno(), selectors.EVENT_READ,
+                    (name, decoder))
+            while selector.get_map():
+                events = selector.select(deadline and max(0, deadline -
+                    monotonic()))
+                if not events and deadline:
+                    deadline = None
+                    with exc(OSError):
+                        self.send_signal(SIGKILL)
+                for key, _ in events:
+                    name, decoder = key.data
+                    data = os.read(key.fd, 65536)
+                    if not data:
+                        selector.unregister(key.fd)
+                    chunk = decoder.decode(data, not data) if decoder \
+                        else data
+                    if chunk:
+                        _keep(*kept[name], chunk, tail)
+                        yield name, chunk
+        for name, pipe in pipes.items():
+            pipe.close()
+            setattr(self, name, empty.join(kept[name][0]))
+        self.code = self.wait()
+
+    def lines(self, tail=TAIL, timeout=None):
+        r'''Yield ('stdout' or 'stderr', line) pairs as the command writes
+        them, as chunks does
+
+        >>> [line for _, line in Run('seq 3', asyn=True).lines()]
+        ['1\n', '2\n', '3\n']
+        '''
+        newline = '\n' if self.text_mode else b'\n'
+        partial = {}
+        for name, chunk in self.chunks(tail, timeout):
+            *lines, partial[name] = (partial.get(name, chunk[:0]) +
+                chunk).split(newline)
+            for line in lines:
+                yield name, line + newline
+        for name, line in partial.items():
+            if line:
+                yield name, line
+
+    def stop(self):
+        if not self.poll():
+            with exc(OSError):
+                self.send_signal(SIGTERM)
+        self.get_output()
+
+    def send_signal(self, sig):
+        os.killpg(self.pid, sig)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+
+class AsyncRun:
+    r'''asyncio counterpart of Run, with the same parameters, stop method,
+    asyn parameter and code attrib. Await it (or enter it with async with)
+    to start the command, and in blocking mode to also get its output.
+    Output is decoded as Run does unless universal_newlines is False.
+
+    >>> import asyncio
+    >>> async def main():
+    ...     async with AsyncRun('echo hi; sleep 1000000', asyn=True) as proc:
+    ...         await asyncio.sleep(0.2)
+    ...     return proc.stdout, proc.code
+    >>> asyncio.run(main())
+    ('hi\n', -15)
+    '''
+    def __init__(self, cmd, asyn=False, timeout=None, **kwargs):
+        self.cmd, self.asyn, self.timeout = cmd, asyn, timeout
+        self.kwargs = dict(kwargs)
+        self.proc = self.pid = self.code = self.stdout = self.stderr = None
+
+    def __await__(self):
+        return self._start().__await__()
+
+    async def _start(self):
+        import asyncio
+        kw = dict(self.kwargs)
+        encoding, errors = kw.pop('encoding', None), kw.pop('errors', None)
+        text, newlines = kw.pop('text', None), kw.pop('universal_newlines',
+            True)
+        self._text = bool(encoding or errors or text or newlines)
+        self._codec = encoding, errors or 'strict'
+        kw.setdefault('stdout', PIPE)
+        kw.setdefault('stderr', PIPE)
+        kw['start_new_session'] = True
+        if kw.pop('shell', True):
+            self.proc = await asyncio.create_subprocess_shell(self.cmd, **kw)
+        else:
+            cmd = shlex.split(self.cmd) if isinstance(self.cmd, str) \
+                else self.cmd
+            self.proc = await asyncio.create_subprocess_exec(*cmd, **kw)
+        self.pid = self.proc.pid
+        if self.asyn is False:
+            await self.get_output(self.timeout)
+        return self
+
+    async def get_output(self, timeout=None):
+        import asyncio
+        if self.code is None:
+            # Not cancelled on timeout, keeping the output read so far
+            task = asyncio.ensure_future(self.proc.communicate())
+            if not (await asyncio.wait({task}, timeout=timeout))[0]:
+                with exc(OSError):
+                    self.send_signal(SIGKILL)
+            self.stdout, self.stderr = map(self._decode, await task)
+            self.code = await self.proc.wait()
+        return self.stdout
+
+    def _decode(self, data):
+        if data is None or not self._text:
+            return data
+        import locale
+        encoding, errors = self._codec
+        return data.decode(encoding or locale.getpreferredencoding(False),
+            errors).replace('\r\n', '\n').replace('\r', '\n')
+
+    async def stop(self):
+        if self.proc is None:
+            return
+        if self.proc.returncode is None:
+            with exc(OSError):
+                self.send_signal(SIGTERM)
+        await self.get_output()
+
+    def send_signal(self, sig):
+        os.killpg(self.pid, sig)
+
+    async def __aenter__(self):
+        return self if self.proc else await self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.stop()
+
+
+def _keep(chunks, size, chunk, tail):
+    '''Append chunk to a deque of chunks, keeping its last tail characters.
+    size is a one element list with the total length of chunks.
+    '''
+    chunks.append(chunk)
+    size[0] += len(chunk)
+    while size[0] > tail:
+        over = size[0] - tail
+        if over >= len(chunks[0]):
+            size[0] -= len(chunks.popleft())
+        else:
+            chunks[0] = chunks[0][over:]
+            size[0] = tail
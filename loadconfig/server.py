@@ -0,0 +1,147 @@
+'''loadconfig server keeping parsed configs and clg parsers warm.
+
+scripts/loadconfig talks to it over a unix socket when LOADCONFIG_SOCKET is
+set, spawning it on first use (see loadconfig.client). Responses are cached
+until a file or !env envvar they were built from changes. Responses of
+configs running a checkconfig are not cached, as its outcome may depend on
+more than those. The server exits when idle.
+
+Run as:  python -m loadconfig.server /run/user/1000/loadconfig.sock
+'''
+from . import Config, __version__
+from .client import listening
+from .lib import (capture_stream, exc, file_cache, FileCache, track_sources,
+    _stamps, _stat)
+from contextlib import contextmanager
+import json
+import os
+import socketserver
+import sys
+import traceback
+
+conf = """\
+    clg:
+        description: Serve loadconfig requests on a unix socket.
+        options:
+            idle_timeout:
+                short: t
+                type: float
+                default: 600
+                help: seconds without requests before exiting
+        args:
+            socket_path:
+                help: unix socket to listen on"""
+
+# Cached responses kept by a server, least recently used first
+CACHE_MAX = 256
+
+
+class ConfigServer(socketserver.UnixStreamServer):
+    '''Unix socket server answering loadconfig script requests.
+    Exit after idle_timeout seconds without requests. hits and misses count
+    cached responses.
+    '''
+    def __init__(self, socket_path, idle_timeout=600):
+        self.timeout = idle_timeout
+        self.idle = False
+        self.responses = {}
+        self.file_cache = FileCache(validate=True)
+        self.hits = self.misses = 0
+        umask = os.umask(0o077)
+        try:
+            super().__init__(socket_path, _RequestHandler)
+        finally:
+            os.umask(umask)
+
+    def handle_timeout(self):
+        self.idle = True
+
+    def serve(self):
+        '''Handle requests until idle or stopped. Remove the socket on exit'''
+        try:
+            while not self.idle:
+                self.handle_request()
+        finally:
+            self.server_close()
+            with exc(OSError):
+                os.remove(self.server_address)
+
+    def respond(self, request):
+        '''Return cached or new response for a request'''
+        if request.get('stop'):
+            self.idle = True
+            return {}
+        key = json.dumps([request['conf'], request['args'], request['cwd']])
+        entry = self.responses.pop(key, None)
+        if entry and all(request['env'].get(k) == v
+                for k, v in entry[1].env.items()) and \
+                all(_stat(p) == stamp for p, stamp in entry[2].items()):
+            self.hits += 1
+            self.responses[key] = entry
+            return entry[0]
+        self.misses += 1
+        with _environment(request['cwd'], request['env']), \
+                file_cache(self.file_cache), track_sources() as sources:
+            response = export_config(request['conf'], request['args'])
+        if sources.checked:
+            return response
+        stamps = _stamps(sources, self.file_cache)
+        if len(self.responses) >= CACHE_MAX:
+            del self.responses[next(iter(self.responses))]
+        self.responses[key] = response, sources, stamps
+        return response
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        data = self.rfile.read()
+        # Empty requests just probe the server is listening
+        if data:
+            response = self.server.respond(json.loads(data))
+            self.wfile.write(json.dumps(response).encode())
+
+
+@contextmanager
+def _environment(cwd, env):
+    '''Temporarily run in cwd with env as the process environment'''
+    saved_cwd, saved_env = os.getcwd(), dict(os.environ)
+    os.chdir(cwd)
+    os.environ.clear()
+    os.environ.update(env)
+    try:
+        yield
+    finally:
+        os.chdir(saved_cwd)
+        os.environ.clear()
+        os.environ.update(saved_env)
+
+
+def export_config(conf, args):
+    '''Return the stdout, stderr and code of scripts/loadconfig for args'''
+    stderr, code = '', 0
+    with capture_stream() as stdout:
+        try:
+            c = Config(conf, args, version=__version__)
+            c.export(c.pop('export_format', 'sh'), sys.stdout)
+        except SystemExit as e:
+            if isinstance(e.code, str):
+                stderr, code = e.code + '\n', 1
+            else:
+                code = e.code or 0
+        except Exception:
+            stderr, code = traceback.format_exc(), 1
+    return {'stdout': stdout.getvalue(), 'stderr': stderr, 'code': code}
+
+
+def main(args):
+    c = Config(conf, args)
+    # Leave a live server alone, otherwise replace a stale socket
+    if listening(c.socket_path):
+        return
+    with exc(OSError):
+        os.remove(c.socket_path)
+    with exc(OSError):
+        ConfigServer(c.socket_path, c.idle_timeout).serve()
+
+if __name__ == '__main__':  # pragma: no cover
+    main(sys.argv)
@@ -0,0 +1,182 @@
+'''Keep a Config up to date with its source files.
+
+Watcher reloads a Config in a background thread when one of its -C, !include
+or !read files changes, notifying subscribers with the set of changed keys.
+Linux inotify (through ctypes) wakes the thread on directory events. Other
+systems, or with inotify=False, fall back to checking file mtimes every
+interval seconds.
+
+>>> from loadconfig import Config
+>>> from loadconfig.lib import tempdir, write_file
+>>> from queue import Queue
+>>> changes = Queue()
+>>> with tempdir() as tmpdir:
+...     _ = write_file(f'{tmpdir}/config.conf', 'color: blue')
+...     c = Config(args=['', f'-C={tmpdir}'])
+...     with Watcher(c, interval=0.05) as watcher:
+...         _ = watcher.subscribe(changes.put)
+...         _ = write_file(f'{tmpdir}/config.conf', 'color: red')
+...         changes.get(timeout=5)
+{'color'}
+>>> c.color
+'red'
+'''
+__all__ = ['Watcher']
+
+import ctypes
+import ctypes.util
+from .lib import exc
+import os
+from os.path import dirname
+import selectors
+import struct
+import threading
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO |
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+EVENT = struct.Struct('iIII')
+# Seconds to wait for a burst of events (eg: an editor saving) to settle
+SETTLE = 0.05
+
+
+class _Inotify:
+    '''Minimal inotify binding watching directories'''
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add = libc.inotify_add_watch
+        self._add.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm = libc.inotify_rm_watch
+        self._rm.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.dirs = {}
+
+    def watch(self, dirs):
+        '''Watch exactly dirs, adding and removing watches as needed'''
+        for wd, path in list(self.dirs.items()):
+            if path not in dirs:
+                self._rm(self.fd, wd)
+                del self.dirs[wd]
+        for path in set(dirs) - set(self.dirs.values()):
+            wd = self._add(self.fd, os.fsencode(path), WATCH_MASK)
+            if wd >= 0:
+                self.dirs[wd] = path
+
+    def read(self):
+        '''Return paths of pending events'''
+        paths = set()
+        with exc(BlockingIOError):
+            while True:
+                data = os.read(self.fd, 65536)
+                offset = 0
+                while offset < len(data):
+                    wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+                    name = data[offset + EVENT.size:
+                        offset + EVENT.size + length].rstrip(b'\0')
+                    if wd in self.dirs:
+                        paths.add(os.path.join(self.dirs[wd],
+                            os.fsdecode(name)) if name else self.dirs[wd])
+                    offset += EVENT.size + length
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher:
+    '''Reload config in a background thread when its source files change.
+    Subscribers are called with the set of changed keys from that thread.
+    lock is held while config is being reloaded. A failed reload (eg: a
+    half written yaml file) keeps the previous config and is kept in error.
+    '''
+    def __init__(self, config, interval=1.0, inotify=True):
+        self.config = config
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.error = None
+        self._inotify = None
+        if inotify:
+            with exc(OSError, AttributeError, TypeError):
+                self._inotify = _Inotify()
+        self.backend = 'inotify' if self._inotify else 'poll'
+        self._wake_r, self._wake_w = os.pipe()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, daemon=True,
+            name='loadconfig-watcher')
+
+    def subscribe(self, callback):
+        '''Call callback(changed_keys) after each reload changing keys'''
+        self.subscribers.append(callback)
+        return callback
+
+    def start(self):
+        self._watch()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        '''Stop the watcher thread and release its resources'''
+        self._stopping = True
+        os.write(self._wake_w, b'\0')
+        self._thread.join()
+        for fd in (self._wake_r, self._wake_w):
+            os.close(fd)
+        if self._inotify:
+            self._inotify.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def _files(self):
+        sources = self.config.__dict__.get('_sources')
+        return set(sources[0].files) if sources else set()
+
+    def _watch(self):
+        if self._inotify:
+            self._inotify.watch({dirname(path) for path in self._files()})
+
+    def _run(self):
+        with selectors.DefaultSelector() as selector:
+            selector.register(self._wake_r, selectors.EVENT_READ)
+            if self._inotify:
+                selector.register(self._inotify.fd, selectors.EVENT_READ)
+            while not self._stopping:
+                selector.select(None if self._inotify else self.interval)
+                if self._stopping:
+                    break
+                if self._inotify:
+                    # Let a burst of events settle, then check our files
+                    paths = self._inotify.read()
+                    while selector.select(SETTLE) and not self._stopping:
+                        paths |= self._inotify.read()
+                    if not paths & self._files():
+                        continue
+                self.reload()
+
+    def reload(self):
+        '''Reload config now, notifying subscribers of changed keys'''
+        with self.lock:
+            try:
+                changed = set(self.config.reload())
+            except Exception as e:
+                self.error = e
+                return
+            self.error = None
+            self._watch()
+        if changed:
+            for callback in self.subscribers:
+                callback(changed)
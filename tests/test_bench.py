@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+'''Test benchmarks script on small generated configs
+
+For manual run:
+    python -m pytest tests/test_bench.py
+'''
+
+from loadconfig.lib import addpath
+addpath(__file__, parent=True)
+
+from benchmarks import bench
+from loadconfig.lib import tempdir, write_file
+import json
+
+
+def test_bench_results_and_baseline():
+    with tempdir() as tmpdir:
+        output, baseline = f'{tmpdir}/bench.json', f'{tmpdir}/base.json'
+        assert 0 == bench.main(['bench', '-s', '10', '-k', '_10',
+            '-o', output])
+        with open(output) as fh:
+            results = json.load(fh)['results']
+        assert {'config_flat_10', 'export_10'} <= set(results)
+        assert 'clg_parse_cold_50' not in results
+
+        slower = {name: seconds * 100 for name, seconds in results.items()}
+        write_file(baseline, json.dumps({'results': slower}))
+        assert 0 == bench.main(['bench', '-s', '10', '-k', 'flat_10', '-o',
+            output, '-b', baseline])
+        faster = {name: seconds / 100 for name, seconds in results.items()}
+        write_file(baseline, json.dumps({'results': faster}))
+        assert 1 == bench.main(['bench', '-s', '10', '-k', 'flat_10', '-o',
+            output, '-b', baseline])
@@ -13,9 +13,17 @@ sys.path.insert(0, dirname(abspath(__file__)))
 from loadconfig.lib import addpath
 addpath(__file__, parent=True)
 
-from loadconfig import Config, Odict
-from loadconfig.lib import (exc, run, tempdir, tempfile)
+import asyncio
+import copy
+from concurrent.futures import ThreadPoolExecutor
+from loadconfig import Config, LazyConfig, Odict
+from loadconfig.lib import (CHECK_CODES, CLG_PARSERS, SCHEMAS, SchemaError,
+    check_schema, exc, file_cache, FileCache, run, tempdir, tempfile,
+    track_sources, write_file)
+import loadconfig.lib
+from os import listdir
 from os.path import basename
+import pickle
 from platform import python_version
 from pytest import fixture
 import re
@@ -97,7 +105,8 @@ def test_string_argument_value_integer_is_preserved(f):
 
 def test_clg_key_not_present(f):
     '''Config stores all args including program name'''
-    c = Config(args=[f.prog, f.host, '-E="{}"'.format(f.conf)])
+    c = Config(args=[f.prog, f.host, '-E="{}"'.format(f.conf)],
+        types=[basename])
     assert 'clg' not in c
 
 
@@ -106,10 +115,25 @@ def test_extra_config_and_config_file(f):
         fh.write(f.conf)
         fh.flush()
         c = Config(args=[f.prog, f.host, '-C="{}"'.format(fh.name),
-            '-E="system_path: /tmp/systest"'])
+            '-E="system_path: /tmp/systest"'], types=[basename])
     assert '/tmp/systest' == c.system_path
 
 
+def test_space_separated_options(f):
+    '''-C file, --conf file and --str=string work as -C= and -E='''
+    with tempfile() as fh:
+        fh.write(f.conf)
+        fh.flush()
+        c = Config(args=[f.prog, '--conf', fh.name, f.host,
+            '--str=system_path: /tmp/systest', '-E', 'color: blue'],
+            types=[basename])
+    assert ('/tmp/systest', 'blue', f.host) == (c.system_path, c.color, c.host)
+    c = Config(args=['prog', '-E', 'a: 1', '--', '-E=b: 2'])
+    assert (1, None) == (c.a, c.b)
+    c = Config(args=['prog', '-E'])
+    assert '{}' == repr(c)
+
+
 def test_include_config(f):
     '''Test yaml !include tag loads config'''
     conf = 'field: magnetic'
@@ -186,7 +210,7 @@ def test_extra_config_single_line_properly_handled(f):
 
 def test_attribute_auto_expansion(f):
     c = Config(args=[f.prog, f.host, '-E="{}"'.format(f.conf),
-        '-E="backup_path: /backup/$host.img"'])
+        '-E="backup_path: /backup/$host.img"'], types=[basename])
     assert '/backup/leon.img' == c.backup_path
 
 
@@ -245,7 +269,8 @@ def test_help(f):
 def test_config(f):
     '''Test config process validate args, and generate envvars'''
     c = Config({'version': f.version, 'prog': f.prog},
-               args=[f.prog, 'leon', '-E="{}"'.format(f.conf)])
+               args=[f.prog, 'leon', '-E="{}"'.format(f.conf)],
+               types=[basename])
     # Apparently clg return data out of order. Sort its output here.
     ret = '\n'.join(sorted(c.export().split('\n')))
     exp = dedent('''\
@@ -288,6 +313,37 @@ def test_functional_verprog(f):
     assert re.search(regex, ret.stderr)
 
 
+def test_export_dialects():
+    c = Config("""\
+        path: /opt/$name
+        ports: [80, [443, 'no port']]
+        hosts: [{name: leon}]
+        quote: it's "ok"
+        empty:""")
+    assert dedent('''\
+        export PATH="/opt/$name"
+        PORTS=(80 443 'no port')
+        HOSTS=('{name: leon}')
+        export QUOTE="it's "ok""
+        export EMPTY=""''') == c.export('bash')
+    assert dedent('''\
+        set -gx PATH '/opt/$name'
+        set -gx PORTS '80' '443' 'no port'
+        set -gx HOSTS '{name: leon}'
+        set -gx QUOTE 'it\\'s "ok"'
+        set -gx EMPTY \'\'''') == c.export('fish')
+    assert dedent('''\
+        PATH="/opt/\\$name"
+        PORTS="80 443 'no port'"
+        HOSTS="'{name: leon}'"
+        QUOTE="it's \\"ok\\""
+        EMPTY=""''') == c.export('dotenv')
+    with tempfile() as fh:
+        c.export('env0', fh)
+        fh.seek(0)
+        assert 'PATH=/opt/$name\0PORTS=80 443' == fh.read()[:28]
+
+
 def test_fail_to_find_config(f):
     c = Config(args=['-C="not_config_e76a41.conf"'])
     assert '{}' == repr(c)
@@ -320,6 +376,103 @@ def test_default_cmd():
     assert e().code.startswith('usage:')
 
 
+def test_clg_parser_cache(monkeypatch):
+    conf = """\
+        clg:
+            default_cmd: run
+            options:
+                verbose:
+                    short: v
+                    action: store_true
+            subparsers:
+                run:
+                    help: 'run as:  $prog run'"""
+    CLG_PARSERS.clear()
+    c = Config(conf, args=['netapplet'])
+    assert 'run' == c.command0 and 1 == len(CLG_PARSERS)
+    c = Config(conf, args=['netapplet', '-v', 'run'])
+    assert c.verbose and 1 == len(CLG_PARSERS)
+    c = Config(conf, args=['otherapplet'])
+    assert not c.verbose and 2 == len(CLG_PARSERS)
+    with exc(SystemExit) as e:
+        Config(conf, args=['otherapplet', '--help'])
+    assert e().code.startswith('usage: otherapplet')
+    monkeypatch.setattr(loadconfig.lib, 'CLG_PARSERS_MAX', 2)
+    Config(conf, args=['thirdapplet'])
+    assert 2 == len(CLG_PARSERS)
+
+
+def test_clg_mutable_defaults():
+    '''Configs from a cached parser do not share mutable defaults'''
+    conf = """\
+        clg:
+            options:
+                sizes:
+                    nargs: '+'
+                    type: int
+                    default: [10, 1000]"""
+    c = Config(conf, ['prog'])
+    c.sizes.append(99)
+    assert [10, 1000] == Config(conf, ['prog']).sizes
+
+
+def test_concurrent_loads():
+    '''Threads load configs with their own types, prog, help and includes'''
+    conf = dedent("""\
+        clg:
+            description: |
+                Keep
+                  line breaks
+            args:
+                name:
+                    type: convert""")
+
+    def upper(name):
+        return name.upper()
+    upper.__name__ = 'convert'
+
+    def lower(name):
+        return name.lower()
+    lower.__name__ = 'convert'
+
+    def load(i):
+        convert = (upper, lower)[i % 2]
+        with exc(SystemExit) as e:
+            Config(conf, [f'prog{i}', '-h'], types=[convert])
+        c = Config(f'conf: {{db: !include {tmpdir}/{i % 5}.yml:db}}\n{conf}',
+            [f'prog{i}', 'Name'], types=[convert])
+        return e().code, c.name, c.conf.db
+
+    with tempdir() as tmpdir, ThreadPoolExecutor(8) as pool:
+        for i in range(5):
+            write_file(f'{tmpdir}/{i}.yml', f'db: {{host: host{i}}}')
+        results = list(pool.map(load, range(40)))
+    for i, (usage, name, db) in enumerate(results):
+        assert usage.startswith(f'usage: prog{i} [-h] name')
+        assert 'Keep\n  line breaks' in usage
+        assert ('NAME', 'name')[i % 2] == name
+        assert {'host': f'host{i % 5}'} == db
+
+
+def test_clg_types_not_kept():
+    '''Custom types are only registered in clg while a parser is built'''
+    import clg
+    conf = 'clg: {args: {name: {type: convert}}}'
+    size = len(clg.TYPES)
+    for i in range(20):
+        def convert(name, i=i):
+            return f'{name}{i}'
+        assert f'a{i}' == Config(conf, ['prog', 'a'], types=[convert]).name
+    assert size == len(clg.TYPES)
+
+
+def test_aload():
+    async def load_all():
+        return await asyncio.gather(*(Config.aload(args=['', f'-E=n: {i}'])
+            for i in range(10)))
+    assert list(range(10)) == [c.n for c in asyncio.run(load_all())]
+
+
 def test_run_namespace():
     conf = """\
         prog: netapplet
@@ -349,3 +502,297 @@ def test_run_namespace():
 
     # Assert as string namespace
     assert expected == c.run(__name__ + '.Prog')
+
+
+def test_expand_chained_keys():
+    '''$keys resolve in dependency order, keeping referenced value types'''
+    c = Config('''\
+        backup: $data/backup
+        data: $root/data
+        root: /srv
+        ports: $port_list
+        port_list: [80, 443]
+        port: ${base}0
+        base: 808
+        price: $$5''')
+    assert '/srv/data/backup' == c.backup
+    assert [80, 443] == c.ports
+    assert c.ports is not c.port_list
+    assert 8080 == c.port
+    assert '$5' == c.price
+
+
+def test_expand_long_chains():
+    '''Chains longer than the recursion limit resolve in one walk'''
+    keys = 3000
+    c = Config('\n'.join(f'k{i}: $k{i + 1}' for i in range(keys)) +
+        f'\nk{keys}: end')
+    assert 'end' == c.k0 == c[f'k{keys - 1}']
+
+
+def test_expand_top_level_keys():
+    '''Top level $keys add their rendered key, nested $keys are replaced'''
+    c = Config('{$k: 1, k: key, a: {$k: 2}, $$: x}')
+    assert {'$k': 1, 'k': 'key', 'a': {'key': 2}, '$$': 'x', 'key': 1,
+        '$': 'x'} == c
+
+
+def test_expand_cyclic_keys():
+    with exc(ValueError) as e:
+        Config('first: $second, second: $third, third: $first')
+    assert 'first -> second -> third -> first' in str(e())
+
+
+def test_config_file_cache():
+    '''Parsed -C files are reused until the file or its includes change'''
+    with tempdir() as tmpdir, tempdir() as cache_dir:
+        with open(f'{tmpdir}/common.yml', 'w') as fh:
+            fh.write('db: postgres')
+        with open(f'{tmpdir}/config.conf', 'w') as fh:
+            fh.write(f'common: !include {tmpdir}/common.yml\nport: 80')
+        Config._cache_dir = cache_dir
+        try:
+            c = Config(args=[f'-C={tmpdir}'])
+            assert 1 == len(listdir(cache_dir))
+            assert c == Config(args=[f'-C={tmpdir}'])
+            with open(f'{tmpdir}/common.yml', 'w') as fh:
+                fh.write('db: sqlite')
+            c = Config(args=[f'-C={tmpdir}'])
+        finally:
+            Config._cache_dir = ''
+    assert {'common': {'db': 'sqlite'}, 'port': 80} == c
+
+
+def test_prefetch(monkeypatch):
+    '''-C and !include files are read concurrently once, merged in order'''
+    reads = []
+    read = loadconfig.lib._read
+    monkeypatch.setattr(loadconfig.lib, '_read',
+        lambda path: reads.append(path) or read(path))
+    with tempdir() as tmpdir:
+        write_file(f'{tmpdir}/a.yml', f'!include {tmpdir}/b.yml\nsource: a')
+        write_file(f'{tmpdir}/b.yml', 'source: b\nb: 1')
+        write_file(f'{tmpdir}/c.yml',
+            f'source: c\nd: !include {tmpdir}/d.yml:d')
+        write_file(f'{tmpdir}/d.yml', 'd: {x: 1}')
+        c = Config(args=['', f'-C={tmpdir}/a.yml', f'-C={tmpdir}/c.yml'])
+        assert {'source': 'c', 'b': 1, 'd': {'x': 1}} == c
+        assert sorted(reads) == [f'{tmpdir}/{name}.yml' for name in 'abcd']
+
+
+def test_file_cache():
+    '''!include files are read and parsed once, revalidated by mtime'''
+    with tempdir() as tmpdir:
+        common = f'{tmpdir}/common.yml'
+        write_file(common, '{db: {host: pg}, cache: {host: redis}}')
+        conf = f'db: !include {common}:db\ncache: !include {common}:cache'
+        with file_cache(FileCache(validate=True)) as cache:
+            Config(conf)
+            # common.yml is prefetched, then parsed once
+            assert (2, 2) == (cache.hits, cache.misses)
+            with track_sources() as sources:
+                Config(conf)
+            assert (4, 2) == (cache.hits, cache.misses)
+            assert common in sources.files
+            write_file(common, '{db: {host: mysql}, cache: {host: redis}}')
+            c = Config(conf)
+    assert 'mysql' == c.db.host
+
+
+def test_reload(monkeypatch):
+    assert {} == Config().reload()
+    cache = FileCache(validate=True)
+    monkeypatch.setattr(Config, '_file_cache', cache)
+    with tempdir() as tmpdir:
+        write_file(f'{tmpdir}/db.yml', 'host: pg')
+        write_file(f'{tmpdir}/config.conf',
+            f'db: !include {tmpdir}/db.yml\nregion: !env region\nold: 1')
+        monkeypatch.setenv('REGION', 'eu')
+        c = Config('url: $db', ['prog', f'-C={tmpdir}'])
+        assert {} == c.reload()
+        misses = cache.misses
+
+        write_file(f'{tmpdir}/config.conf',
+            f'db: !include {tmpdir}/db.yml\nregion: !env region\nnew: 2')
+        monkeypatch.setenv('REGION', 'us')
+        assert {'region': ({'region': 'eu'}, {'region': 'us'}),
+            'old': (1, None), 'new': (None, 2)} == c.reload()
+        # Only config.conf was read again
+        assert misses + 1 == cache.misses
+        write_file(f'{tmpdir}/db.yml', 'host: mysql')
+        assert {'db': ({'host': 'pg'}, {'host': 'mysql'}),
+            'url': ({'host': 'pg'}, {'host': 'mysql'})} == c.reload()
+        assert Config('url: $db', ['prog', f'-C={tmpdir}']) == c
+
+        lazy = LazyConfig('url: $db', ['prog', f'-C={tmpdir}'])
+        write_file(f'{tmpdir}/db.yml', 'host: pg')
+        assert ['db', 'url'] == sorted(lazy.reload())
+        assert 'pg' == lazy.url.host
+
+        # Keys set by hand are replaced once sources change
+        c.url, c.extra = 'manual', 1
+        assert {'db': ({'host': 'mysql'}, {'host': 'pg'}), 'url': ('manual',
+            {'host': 'pg'}), 'extra': (1, None)} == c.reload()
+
+
+def test_reload_cache_dir(monkeypatch):
+    '''Configs from pickled -C files still track their !env envvars'''
+    with tempdir() as tmpdir:
+        monkeypatch.setattr(Config, '_cache_dir', f'{tmpdir}/cache')
+        write_file(f'{tmpdir}/config.conf', 'region: !env region')
+        monkeypatch.setenv('REGION', 'eu')
+        Config(args=['prog', f'-C={tmpdir}'])
+        c = Config(args=['prog', f'-C={tmpdir}'])
+        monkeypatch.setenv('REGION', 'us')
+        assert ['region'] == list(c.reload())
+        assert Config(args=['prog', f'-C={tmpdir}']) == c
+
+
+def test_copy_loaded_config():
+    '''Loaded configs keep their inputs and sources, and still copy'''
+    c = Config('db: {host: pg}', ['prog', '-E={port: 5432}'])
+    assert '_inputs' in c.__dict__
+    for new in (copy.copy(c), copy.deepcopy(c), pickle.loads(pickle.dumps(c))):
+        assert (c, Config) == (new, type(new)) and new._inputs == c._inputs
+
+
+def test_pickle():
+    '''Configs keep no FileCache, only the sources reload needs'''
+    with tempdir() as tmpdir:
+        write_file(f'{tmpdir}/config.conf', 'db: {host: pg}')
+        c = Config(args=['prog', f'-C={tmpdir}'])
+        data = pickle.dumps(c)
+        assert b'FileCache' not in data
+        new = pickle.loads(data)
+        assert (c, Config) == (new, type(new))
+        assert ['_inputs', '_sources'] == sorted(c.__dict__)
+        write_file(f'{tmpdir}/config.conf', 'db: {host: mysql}')
+        assert 'db' in new.reload() and 'mysql' == new.db.host
+    assert {} == copy.copy(Config()).__dict__
+
+
+def test_checkschema():
+    conf = dedent('''\
+        name: web
+        port: 80
+        debug: true
+        hosts: [leon, sasha]
+        checkschema:
+            name: {type: str, match: '^[a-z]+$', min: 2}
+            port: {type: int, min: 1, max: 65535}
+            debug: bool
+            ratio: float
+            hosts: {items: str, max: 2}
+            db: {keys: {host: {required: true}}, min: 1}''')
+    c = Config(conf)
+    assert 'checkschema' not in c and 80 == c.port
+    with exc(ValueError) as e:
+        Config(conf, ['prog', '-E={name: Web1, port: true, ratio: 1, '
+            'hosts: [a, b, 3], db: {}}'])
+    assert e().args[0].split('\n')[1:] == [
+        '  name: Web1 does not match ^[a-z]+$', '  port: true is not int',
+        '  hosts: [a, b, 3] is above max 2', '  hosts:2: 3 is not str',
+        '  db: {} is below min 1', '  db:host: required key is missing']
+    with exc(ValueError) as e:
+        Config('checkschema: {a: date}')
+    assert 'Unknown checkschema type date' == e().args[0]
+    with exc(ValueError) as e:
+        check_schema({'ports': [1, 'a']}, {'ports': {'items': 'int'}})
+    assert '  ports:1: a is not int' == e().args[0].split('\n')[1]
+
+
+def test_checkschema_coercion():
+    def hostport(value):
+        host, port = value.split(':')
+        return Odict(host=host, port=int(port))
+    conf = dedent('''\
+        port: '8080'
+        ratio: 1
+        ports: ['80', 443]
+        db: pg:5432
+        checkschema:
+            port: int
+            ratio: float
+            debug: {type: bool, default: false}
+            ports: {items: int}
+            db: {type: hostport, required: true}
+            cache: {keys: {size: {default: [64]}}, default: {}}''')
+    c = Config(conf, types={hostport})
+    assert (8080, 1.0, False, [80, 443]) == (c.port, c.ratio, c.debug, c.ports)
+    assert isinstance(c.ratio, float) and {'host': 'pg', 'port': 5432} == c.db
+    assert {'size': [64]} == c.cache
+    with exc(SchemaError) as e:
+        Config(conf, ['prog', '-E={debug: maybe, db: pg}'], types={hostport})
+    assert [('debug', 'maybe is not bool'), ('db', 'pg is not hostport: '
+        'not enough values to unpack (expected 2, got 1)')] == e().errors
+
+
+def test_checkschema_guards_and_malformed_specs():
+    def errors(data, schema):
+        with exc(SchemaError) as e:
+            check_schema(Odict(data), Odict(schema))
+        return e().errors
+    assert [('db', 'null has no size for min or max')] == errors(
+        'db: null', '{db: {min: 1}}')
+    assert [('n', '3 is not list')] == errors('n: 3',
+        '{n: {type: any, items: int}}')
+    assert [('s', 'abc is not map')] == errors('s: abc',
+        '{s: {type: any, keys: {a: {required: true}}}}')
+    assert [('t', 'true has no size for min or max')] == errors('t: true',
+        '{t: {max: 3}}')
+    for schema, error in (
+            ('checkschema: [a]', 'Invalid checkschema: [a] is not a map of '
+                'keys to specs'),
+            ('checkschema: {a: [int]}', 'Invalid checkschema spec a: type '
+                '[int] is not str'),
+            ('checkschema: {a: {keys: {b: {size: 1}}}}', 'Invalid '
+                'checkschema spec a:b: unknown option size'),
+            ('checkschema: {a: {items: {max: true}}}', 'Invalid checkschema '
+                'spec a:items: max true is not int or float'),
+            ('checkschema: {a: {match: "("}}', 'Invalid checkschema spec a: '
+                'match missing ), unterminated subpattern at position 0')):
+        with exc(ValueError) as e:
+            Config(schema)
+        assert error == e().args[0]
+
+
+def test_checkconfig_code_cache(monkeypatch):
+    conf = dedent('''\
+        greeting: $name
+        checkconfig: |
+            self.setdefault('name', 'world')''')
+    assert 'world' == Config(conf).greeting
+    with tempdir() as tmpdir:
+        monkeypatch.setattr(Config, '_cache_dir', tmpdir)
+        CHECK_CODES.clear()
+        assert {'greeting': 'world', 'name': 'world'} == Config(conf)
+        assert 1 == len([f for f in listdir(tmpdir) if 'checkconfig' in f])
+        CHECK_CODES.clear()
+        assert 'world' == Config(conf).greeting
+        # Sources rendered from $keys are not persisted
+        for host in ('leon', 'sasha'):
+            Config(f'host: {host}\ncheckconfig: assert "$host" == "{host}"')
+        assert 1 == len([f for f in listdir(tmpdir) if 'checkconfig' in f])
+        lazy = LazyConfig('host: leon\ncheckconfig: assert "$host"')
+        assert 'leon' == lazy.host and 1 == len(listdir(tmpdir))
+        monkeypatch.setattr(loadconfig.lib, 'CHECKS_MAX', 1)
+        Config('checkconfig: x = 1')
+        assert 1 == len([f for f in listdir(tmpdir) if 'checkconfig' in f])
+        CHECK_CODES.clear()
+        SCHEMAS.clear()
+        Config('checkconfig: pass\ncheckschema: {a: int}')
+        Config('checkschema: {a: str}')
+        assert (1, 1) == (len(CHECK_CODES), len(SCHEMAS))
+
+
+def test_concurrent_checks(monkeypatch):
+    '''Threads share the checkconfig and checkschema caches at capacity'''
+    monkeypatch.setattr(loadconfig.lib, 'CHECKS_MAX', 4)
+
+    def load(i):
+        return Config(f'a: {i % 16}\ncheckschema: {{a: {{max: {i % 16}}}}}\n'
+            f'checkconfig: x = {i % 16}').a
+
+    with ThreadPoolExecutor(8) as pool:
+        assert [i % 16 for i in range(800)] == list(pool.map(load, range(800)))
+    assert (4, 4) == (len(CHECK_CODES), len(SCHEMAS))
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+'''Test LazyConfig class gives the same results as Config
+
+pytest is recommented for running this test file.
+For manual run:
+    pip install pytest pytest-cov pyyaml clg
+    pytest tests/test_lazy.py
+'''
+from loadconfig import Config, LazyConfig
+from loadconfig.lib import exc, tempdir, write_file
+from os.path import basename
+import pickle
+from pytest import fixture, mark
+
+conf = '''\
+    clg:
+        description: Build a full system
+        default_cmd: build
+        options:
+            version:
+                short: v
+                action: version
+                version: $prog $version
+            extra_config:
+                short: e
+                type: basename
+        subparsers:
+            build:
+                args:
+                    host:
+                        nargs: '?'
+                        default: leon
+            clean: {help: Clean data}
+    checkconfig: |
+        if '$command0' == 'clean' and '$data_path' == '/':
+            raise Exception('Refusing to clean /')
+    data_file: $data_path/data.txt
+    backup_path: /backup/$host.img
+    docker__image: reg.gdl/debian'''
+
+
+@fixture(scope='module')
+def files():
+    '''Config files for include, read and -C options'''
+    with tempdir() as tmpdir:
+        write_file(f'{tmpdir}/birds.yml', 'hummingbird: {colors: [teal]}')
+        write_file(f'{tmpdir}/path.txt', '/usr/$lib')
+        write_file(f'{tmpdir}/config.conf', 'data_path: /srv, $$: x')
+        write_file(f'{tmpdir}/build.conf', f'!include {tmpdir}/birds.yml\n'
+            'data_path: /data\nhost: sasha')
+        yield tmpdir
+
+
+cases = {
+    'chains': dict(config_data='''\
+        backup: $data/backup
+        data: $root/data
+        root: /srv
+        ports: $port_list
+        port_list: [http, https]
+        port: ${base}0
+        base: 808'''),
+    'overrides': dict(config_data='a: $b, b: 1, c: $d',
+        args=['', '-E="b: 2"', '-E="d: $b"', '-E="d: 3"']),
+    'escapes': dict(config_data='price: $$5, cost: $$$$x, y: $$z',
+        args=['', '-E="x: 1"', '-E="z: 2"']),
+    'late keys': dict(config_data='a: $x-$host, b: [$host]',
+        args=['', '-E="x: 1"', '-E="x: 2"', '-E="host: leon"']),
+    'yaml features': dict(config_data='''\
+        base: &base {user: admin, groups: [$user]}
+        user: root
+        web:
+          <<: *base
+          port: 80
+        db: *base
+        pair: {first: *base, second: *base}
+        dancers: !!set {Zeela, Kim}'''),
+    'dict source': dict(config_data={'a': '$b', 'b': {'c': [1, '$d']},
+        'd': 4}),
+    'clg': dict(config_data=conf, types={basename},
+        args=['dbuild', '-E="data_path: /data"']),
+    'clg subcommand': dict(config_data=conf, types={basename},
+        args=['dbuild', 'clean', '-E="data_path: /tmp"']),
+    'clg types': dict(config_data=conf, types={basename},
+        args=['dbuild', '-e', '/a/b.conf', 'build', 'sasha']),
+    'version': dict(config_data='greeting: $prog $version', version='0.1',
+        args=['hi', '-E="clg: {description: Greet}"']),
+    'prog with $': dict(config_data='clg: {description: Greet}',
+        args=['$name', '-E="name: hi"']),
+    'layers rendered per merge': dict(config_data='d: x${f}y',
+        args=['', '-E="f: $c"', '-E="c: 2"']),
+    'layers overriding cycles': dict(config_data='c: $d',
+        args=['', '-E="b: x${c}y"', '-E="d: x${b}y"', '-E="b: x${a}y"']),
+    'layers with escapes': dict(config_data='c: x${e}y\nd: x${c}y\ne: $$e',
+        args=['', '-E="e: x${c}y"', '-E="d: $f"', '-E="c: x${d}y"']),
+    'layers with top level $keys': dict(config_data='{$k: 1, k: key}',
+        args=['', '-E="k: other"', '-E="key: $k"']),
+    'long chain': dict(config_data='\n'.join(f'k{i}: $k{i + 1}'
+        for i in range(1500)) + '\nk1500: end', args=['', '-E="k1500: 1"']),
+}
+
+file_cases = {
+    'include': 'photon: !include {0}/birds.yml:hummingbird',
+    'expand': '_: !include {0}/birds.yml:&\n'
+        'colors: !expand hummingbird:colors',
+    'pre-include': 'lib: lib64\n!include {0}/birds.yml\nteal: $hummingbird',
+    'read': 'lib: lib64\npath: !read {0}/path.txt',
+    'env': '!env lazy_city',
+    'config file': ['', '-C={0}'],
+    'config files': ['dbuild', '-C={0}/build.conf', '-C={0}', '-E="{1}"'],
+}
+
+
+@mark.parametrize('name', cases)
+def test_same_as_config(name):
+    kwargs = cases[name]
+    eager, lazy = Config(**kwargs), LazyConfig(**kwargs)
+    assert repr(eager) == repr(lazy)
+    assert eager.export() == lazy.export()
+
+
+@mark.parametrize('name', file_cases)
+def test_same_as_config_with_files(name, files, monkeypatch):
+    monkeypatch.setenv('LAZY_CITY', 'San Francisco')
+    case = file_cases[name]
+    if isinstance(case, str):
+        kwargs = dict(config_data=case.format(files))
+    else:
+        kwargs = dict(args=[arg.format(files, conf) for arg in case],
+            types={basename})
+    eager, lazy = Config(**kwargs), LazyConfig(**kwargs)
+    assert repr(eager) == repr(lazy)
+
+
+def test_same_after_changes():
+    '''Keys set after loading do not affect keys loaded before'''
+    eager, lazy = (cls('a: $b, b: 1, c: $d, e: $b', args=['', '-E="f: $b"'])
+        for cls in (Config, LazyConfig))
+    for c in (eager, lazy):
+        c.b = 2
+        c.d = 3
+        c.update('e: 5, _: hidden')
+        del c.f
+    assert repr(eager) == repr(lazy)
+
+
+def test_sections_load_on_access():
+    c = LazyConfig('a: {b: 1}\nc: [$e]\ne: x', args=['', '-E="d: $c"'])
+    assert ['x'] == c.d
+    assert not isinstance(dict.__getitem__(c, 'a'), dict)
+    assert {'b': 1} == c.a
+
+
+def test_cyclic_reference_on_access():
+    with exc(ValueError) as e:
+        Config('a: $b, b: $a, c: 1')
+    assert e()
+    c = LazyConfig('a: $b, b: $a, c: 1')
+    assert 1 == c.c
+    with exc(ValueError) as e:
+        c.a
+    assert 'a -> b -> a' in str(e())
+
+
+def test_mapping_methods():
+    c = LazyConfig('a: $b, b: 1, c: [$b]')
+    assert 1 == c.get('a')
+    assert c.get('x') is None
+    assert 1 == c.setdefault('a', 2)
+    assert 3 == c.setdefault('x', 3)
+    assert 3 == c.pop('x')
+    assert 0 == c.pop('x', 0)
+    assert ('c', [1]) == c.popitem()
+    assert {'a': 1, 'b': 1} == c.copy()
+    assert [1, 1] == list(c.values())
+    assert {'a': 1, 'b': 1} == dict(c) and ['a', 'b'] == list(c)
+    assert c != {}
+    c = LazyConfig('a: $b, b: 1')
+    assert {'a': 1, 'b': 1} == pickle.loads(pickle.dumps(c))
@@ -6,9 +6,19 @@ For manual run:
     pip install -rtests/test_requirements.txt
     python -m pytest tests/test_lib.py
 '''
-from loadconfig.lib import exc, last, Run, run, tempdir
-from os.path import isfile
-from time import sleep
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from loadconfig import Config
+from loadconfig.lib import (arun, AsyncRun, attach, exc, last, ppath,
+    publish, Run, run, run_batch, tempdir)
+import os
+from os.path import dirname, isfile
+from subprocess import PIPE
+import sys
+from time import monotonic, sleep
+
+# Import budget for loadconfig, in microseconds (about 60ms measured)
+IMPORT_BUDGET = 100000
 
 
 def test_Run():
@@ -45,6 +55,63 @@ def test_run_inexistent_cmd():
     assert 127 == ret._r['code']
 
 
+def test_run_batch():
+    start = monotonic()
+    rets = run_batch([f'sleep 0.{i}; echo {i}' for i in (3, 1, 2, 3)],
+        workers=4)
+    assert ['3\n', '1\n', '2\n', '3\n'] == rets and monotonic() - start < 1
+    assert [0] * 4 == [ret.code for ret in rets]
+    # Timed out commands are killed with the processes they started
+    start = monotonic()
+    ret, = run_batch(['echo hi; sleep 100 & sleep 100'], timeout=0.2)
+    assert ('hi\n', -9) == (ret.stdout, ret.code) and monotonic() - start < 5
+    assert [] == run_batch([])
+
+
+def test_Run_stream():
+    '''Output is processed while the command runs, keeping only its tail'''
+    proc = Run('for i in 1 2 3; do echo $i; sleep 0.1; done; printf end >&2',
+        asyn=True, stdin=PIPE)
+    assert [('stdout', '1\n'), ('stdout', '2\n'), ('stdout', '3\n'),
+        ('stderr', 'end')] == list(proc.lines(tail=4))
+    assert ('2\n3\n', 'end', 0) == (proc.stdout, proc.stderr, proc.code)
+    proc = Run('seq 3; printf 4', asyn=True, universal_newlines=False)
+    assert [b'1\n', b'2\n', b'3\n', b'4'] == [line for _, line in
+        proc.lines()]
+    start = monotonic()
+    proc = Run('echo hi; sleep 100 & sleep 100', asyn=True)
+    assert [('stdout', 'hi\n')] == list(proc.chunks(timeout=0.2))
+    assert -9 == proc.code and monotonic() - start < 5
+    ret = run('yes | head -c 1000000; sleep 100', tail=1000, timeout=0.5)
+    assert ('y\n' * 500, -9) == (ret.stdout, ret.code)
+
+
+def test_AsyncRun():
+    async def main():
+        # Many commands are supervised concurrently from one thread
+        rets = await asyncio.gather(*(arun(f'sleep 0.3; echo {i}')
+            for i in range(100)))
+        assert [f'{i}\n' for i in range(100)] == rets
+        ret = await arun('echo hi; echo ho >&2; sleep 100 & sleep 100',
+            timeout=0.2)
+        assert ('hi\n', 'ho\n', -9) == (ret.stdout, ret.stderr, ret.code)
+        proc = await AsyncRun('printf "a\r\nb"', shell=False)
+        assert ('a\nb', 0) == (proc.stdout, proc.code)
+        proc = await AsyncRun(['printf', 'a\r\n'], shell=False,
+            universal_newlines=False, stderr=None)
+        assert (b'a\r\n', None) == (proc.stdout, proc.stderr)
+        async with await AsyncRun('exit 3', asyn=True) as proc:
+            await proc.proc.wait()
+        assert 3 == proc.code
+        # Stopping a command never started is a no-op
+        proc = AsyncRun('true', asyn=True)
+        await proc.stop()
+        assert (None, None) == (proc.proc, proc.code)
+    start = monotonic()
+    asyncio.run(main())
+    assert monotonic() - start < 5
+
+
 def test_Run_unicode():
     '''Test unicode is handled properly'''
     with exc(UnicodeDecodeError) as e:
@@ -60,3 +127,24 @@ def test_exc():
 
 def test_last():
     assert None is last([])
+
+
+def test_import_time():
+    '''Config without cli arguments leaves clg and subprocess unimported'''
+    code = ('import loadconfig, sys; loadconfig.Config("a: 1"); print(*[m for'
+        ' m in ("argparse", "clg", "subprocess", "tempfile")'
+        ' if m in sys.modules])')
+    ret = run('PYTHONPATH={} {} -X importtime -c \'{}\''.format(
+        dirname(ppath(__file__)), sys.executable, code))
+    assert (0, '\n') == (ret.code, ret.stdout)
+    times = dict(line.split('|')[1:][::-1] for line in
+        ret.stderr.splitlines() if line.startswith('import time:'))
+    assert int(times[' loadconfig']) < IMPORT_BUDGET
+
+
+def test_publish_attach():
+    '''Pool workers attach to a config published once to shared memory'''
+    c = Config('db: {host: pg}\nhosts: [leon, sasha]', ['prog'])
+    with publish(c) as name, ProcessPoolExecutor(2) as pool:
+        assert [c, c] == list(pool.map(attach, [name, name]))
+    assert not os.path.exists(f'/dev/shm/{name}')
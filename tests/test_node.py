@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+'''Test ConfigNode compact read only config trees
+
+For manual run:
+    python -m pytest tests/test_node.py
+'''
+
+from loadconfig.lib import addpath
+addpath(__file__, parent=True)
+
+from copy import deepcopy
+from loadconfig import Config, Odict
+from loadconfig.node import ConfigNode, compact, thaw
+import pickle
+from pytest import raises
+import tracemalloc
+
+
+def inventory(hosts):
+    '''Yaml string of a generated inventory with many small mappings'''
+    return '\n'.join(f'host{i}: {{ip: 10.0.{i // 256}.{i % 256}, port: 80, '
+        f'tags: [web, eu]}}' for i in range(hosts))
+
+
+def test_access():
+    node = compact(Config('{db: {host: pg, port: 5432}, hosts: [a, {b: 1}]}'))
+    assert ('pg', 5432, None) == (node.db.host, node['db']['port'], node.user)
+    assert ('a', 1) == (node.hosts[0], node.hosts[1].b)
+    assert ['db', 'hosts'] == list(node) and 2 == len(node)
+    assert 'db' in node and 'user' not in node
+    assert {'host': 'pg', 'port': 5432} == dict(node.db.items())
+    with raises(KeyError):
+        node['user']
+    assert 'db:\n  host: pg\n  port: 5432\nhosts:\n  - a\n  - b: 1' == node._s
+    assert '{db: {host: pg, port: 5432}, hosts: [a, {b: 1}]}' == node._r
+
+
+def test_read_only():
+    node = ConfigNode({'db': {'host': 'pg'}})
+    for change in (lambda: setattr(node, 'db', 1), lambda: delattr(node, 'db'),
+            lambda: node.__setitem__('db', 1),
+            lambda: node.__delitem__('db')):
+        with raises(TypeError):
+            change()
+    with raises(AttributeError):
+        ConfigNode.__new__(ConfigNode)._shape
+
+
+def test_shared_shapes_and_equality():
+    node = compact(Odict(inventory(3)))
+    assert node.host0._shape is node.host2._shape
+    assert node.host0 != node.host1 and node.host1 == compact(
+        {'ip': '10.0.0.1', 'port': 80, 'tags': ['web', 'eu']})
+    assert node == thaw(node) and thaw(node) == node
+    assert node != []
+    # 1 == True, but they are different keys
+    assert [1] == list(ConfigNode({1: 'a'})) and [True] == list(
+        ConfigNode({True: 'a'}))
+    assert ConfigNode(a=1) == ConfigNode([('a', 1)])
+
+
+def test_copy_and_pickle():
+    node = compact(Odict(inventory(3)))
+    new = pickle.loads(pickle.dumps(node))
+    assert node == deepcopy(node) == new
+    # Key tables are pickled once and shared again once unpickled
+    assert new.host0._shape is new.host2._shape is node.host1._shape
+
+
+def test_memory():
+    '''Compact trees of generated inventories take less than half the memory'''
+    yaml_string = inventory(2000)
+    tracemalloc.start()
+    try:
+        odict = Odict(yaml_string)
+        odict_size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        start = tracemalloc.get_traced_memory()[0]
+        node = compact(odict)
+        node_size = tracemalloc.get_traced_memory()[0] - start
+    finally:
+        tracemalloc.stop()
+    assert node == odict and node_size * 2 < odict_size
+
+
+def test_freeze():
+    c = Config('db: {host: pg, port: 5432}\napp: {workers: 4, tags: [web]}')
+    snapshot = c.freeze()
+    c.db.host = 'mysql'
+    assert 'pg' == snapshot.db.host and {snapshot: 1}[compact(
+        Config('db: {host: pg, port: 5432}\napp: {workers: 4, tags: [web]}'))]
+    variant = snapshot.set('db:port', 5433)
+    assert (5433, 5432) == (variant.db.port, snapshot.db.port)
+    assert variant.app is snapshot.app
+    assert variant.db._shape is snapshot.db._shape
+    assert hash(variant) != hash(snapshot) and variant != snapshot
+    assert 'x' == snapshot.set('db:host:name', 'x').db.host.name and 'pg' == \
+        snapshot.set(('db', 'host'), {'name': 'pg'}).db.host.name
+    updated = snapshot.update({'app': {'workers': 8}}, log='debug')
+    assert (8, 'debug', None) == (updated.app.workers, updated.log,
+        updated.app.tags)
+    assert updated.db is snapshot.db
+
+
+def test_sets():
+    '''!!set values become frozensets, so snapshots stay hashable'''
+    c = Config('dancers: !!set {Zeela, Kim}\nteam: {tags: !!set {a}}')
+    snapshot = c.freeze()
+    assert frozenset({'Zeela', 'Kim'}) == snapshot.dancers
+    assert isinstance(snapshot.team.tags, frozenset) and hash(snapshot)
+    assert snapshot == c and isinstance(thaw(snapshot).dancers, set)
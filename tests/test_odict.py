@@ -8,7 +8,8 @@ For manual run:
 '''
 from os import environ
 from loadconfig import Config, Odict
-from loadconfig.lib import tempfile
+from loadconfig.lib import (exc, file_cache, Loader, tempdir, tempfile,
+    write_file, yaml_backend)
 from yaml import safe_load
 
 
@@ -119,3 +120,62 @@ def test_read():
 def test_env_unexistent():
     c = Config('!env city')
     assert '' == c.city
+
+
+def test_yaml_backends():
+    '''libyaml and python backends load and dump the same'''
+    with tempfile() as fh:
+        fh.write('magnetic: {unit: tesla}\n')
+        fh.flush()
+        conf = f'''\
+            _: !include {fh.name}:&
+            field: !expand magnetic
+            units: !include {fh.name}:magnetic:unit
+            list: &l [1, 2]
+            again: *l
+            '''
+        backend = yaml_backend()
+        results = []
+        try:
+            for name in ('python', 'libyaml'):
+                yaml_backend(name)
+                d = Odict(conf)
+                results.append((repr(d), str(d)))
+        finally:
+            yaml_backend(backend)
+    assert results[0] == results[1]
+    assert "{_: '', field: {unit: tesla}, units: tesla, list: [1, 2], " \
+        "again: [1, 2]}" == results[0][0]
+
+
+def test_pre_include_several_files():
+    '''Each pre-processed !include line is spliced with its own file'''
+    with tempdir() as tmpdir:
+        write_file(f'{tmpdir}/a.yml', f'a: 1\n!include {tmpdir}/c.yml\n')
+        write_file(f'{tmpdir}/b.yml', 'b: 2\n')
+        write_file(f'{tmpdir}/c.yml', 'c: 3\n')
+        yaml_string = f'!include {tmpdir}/a.yml\nx: 0\n!include {tmpdir}/b.yml'
+        assert '{a: 1, c: 3, x: 0, b: 2}' == repr(Odict(yaml_string))
+        loader = Loader(yaml_string)
+        assert (f'{tmpdir}/c.yml', 1) == loader.source(2)
+        assert ('<string>', 2) == loader.source(3)
+        assert (f'{tmpdir}/b.yml', 1) == loader.source(4)
+
+
+def test_pre_include_cycle():
+    with tempdir() as tmpdir:
+        write_file(f'{tmpdir}/a.yml', f'!include {tmpdir}/b.yml')
+        write_file(f'{tmpdir}/b.yml', f'!include {tmpdir}/a.yml')
+        with exc(ValueError) as e:
+            Odict(f'!include {tmpdir}/a.yml')
+    assert str(e()).startswith('Cyclic !include')
+
+
+def test_include_subtree_is_a_copy():
+    '''Mutating an included subtree leaves the cached file data untouched'''
+    with tempfile() as fh, file_cache():
+        fh.write('db: {hosts: [pg1, pg2]}')
+        fh.flush()
+        c = Config(f'db: !include {fh.name}:db')
+        c.db.hosts.append('pg3')
+        assert ['pg1', 'pg2'] == Config(f'db: !include {fh.name}:db').db.hosts
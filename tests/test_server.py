@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+'''Test loadconfig server and its script client
+
+For manual run:
+    python -m pytest tests/test_server.py
+'''
+
+from loadconfig.lib import addpath
+addpath(__file__, parent=True)
+
+from loadconfig.lib import import_file, ppath, run, tempdir, write_file
+from loadconfig import __version__
+from loadconfig.client import listening, request, stop
+from loadconfig.server import ConfigServer, export_config, main
+import loadconfig.server
+import os
+from os.path import dirname
+import sys
+from pytest import fixture
+from threading import Thread
+import time
+
+script_path = '{}/../scripts/loadconfig'.format(ppath(__file__))
+script = import_file(script_path)
+
+# Import budget of the script answered by a server, in microseconds (about
+# 20ms measured)
+CLIENT_IMPORT_BUDGET = 50000
+
+
+@fixture
+def server():
+    '''ConfigServer running in a thread on a temporary socket'''
+    with tempdir() as tmpdir:
+        server = ConfigServer(f'{tmpdir}/loadconfig.sock')
+        thread = Thread(target=server.serve)
+        thread.start()
+        yield server
+        stop(server.server_address)
+        thread.join()
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
+def test_cached_response(server, monkeypatch):
+    with tempdir() as tmpdir:
+        write_file(f'{tmpdir}/config.conf', '!env db_host')
+        args = ['prog', f'-C={tmpdir}', '-F', 'dotenv', 'one']
+        os.environ['DB_HOST'] = 'pg'
+        response = request(server.server_address, script.conf, args)
+        assert response == export_config(script.conf, args)
+        assert 'DB_HOST="pg"\nARGS="one"\n' in response['stdout']
+        assert response == request(server.server_address, script.conf, args)
+        assert (1, 1) == (server.hits, server.misses)
+
+        write_file(f'{tmpdir}/config.conf', '!env db_port')
+        assert 'DB_PORT=""' in request(server.server_address, script.conf,
+            args)['stdout']
+        write_file(f'{tmpdir}/config.conf', '!env db_host')
+        os.environ['DB_HOST'] = 'mysql'
+        assert 'DB_HOST="mysql"' in request(server.server_address,
+            script.conf, args)['stdout']
+        del os.environ['DB_HOST']
+        monkeypatch.setattr(loadconfig.server, 'CACHE_MAX', 1)
+        request(server.server_address, script.conf, ['prog'])
+    assert (1, 4) == (server.hits, server.misses) and 1 == len(
+        server.responses)
+
+
+def test_checkconfig_not_cached(server):
+    '''checkconfig runs on every request, as it would locally'''
+    with tempdir() as tmpdir:
+        write_file(f'{tmpdir}/config.conf', 'checkconfig: |\n'
+            f'    assert __import__("os").path.exists("{tmpdir}/conf.py")')
+        write_file(f'{tmpdir}/conf.py', '')
+        args = ['prog', f'-C={tmpdir}']
+        assert 0 == request(server.server_address, script.conf, args)['code']
+        os.remove(f'{tmpdir}/conf.py')
+        ret = request(server.server_address, script.conf, args)
+        assert ret == export_config(script.conf, args) and 1 == ret['code']
+    assert (0, 2, {}) == (server.hits, server.misses, server.responses)
+
+
+def test_errors_and_exit_codes(server):
+    ret = request(server.server_address, script.conf, ['prog', '-v'])
+    assert (f'prog {__version__}\n', 1) == (ret['stderr'], ret['code'])
+    ret = request(server.server_address, 'checkconfig: raise Exception()',
+        ['prog'])
+    assert 1 == ret['code'] and 'Traceback' in ret['stderr']
+    ret = request(server.server_address, 'checkconfig: exit()', ['prog'])
+    assert ('', 0) == (ret['stderr'], ret['code'])
+
+
+def test_script_client_import_time(server):
+    '''Answered requests only import the standard library client'''
+    ret = run('LOADCONFIG_SOCKET={} PYTHONPATH={} {} -X importtime {} '
+        '-E "greet: hi"'.format(server.server_address, dirname(ppath(
+        __file__)), sys.executable, script_path))
+    assert (0, 1) == (ret.code, server.misses)
+    assert 'export GREET="hi"' in ret.stdout
+    imports = [line.split('|')[1:] for line in ret.stderr.splitlines()
+        if line.startswith('import time:') and 'imported package' not in line]
+    assert not {'loadconfig', 'yaml', 'clg', 'argparse', 'subprocess'} & {
+        name.strip() for _, name in imports}
+    assert sum(int(cumulative) for cumulative, name in imports
+        if not name.startswith('  ')) < CLIENT_IMPORT_BUDGET
+
+
+def test_idle_server_exits():
+    with tempdir() as tmpdir:
+        socket_path = f'{tmpdir}/loadconfig.sock'
+        assert None is request(socket_path, '', ['prog'], spawn=False)
+        assert None is request(socket_path * 10, '', ['prog'])  # Too long
+        thread = Thread(target=main, args=[['server', '-t', '0.2',
+            socket_path]])
+        thread.start()
+        assert wait_for(lambda: listening(socket_path))
+        # A second server leaves the first one alone
+        main(['server', socket_path])
+        thread.join()
+        assert not os.path.exists(socket_path)
+
+
+def test_script_spawns_server(monkeypatch):
+    with tempdir() as tmpdir:
+        socket_path = f'{tmpdir}/loadconfig.sock'
+        cmd = 'LOADCONFIG_SOCKET={} PYTHONPATH={} {} -E "greet: hi"'.format(
+            socket_path, dirname(ppath(__file__)), script_path)
+        assert 'export GREET="hi"' in run(cmd).stdout
+        assert wait_for(lambda: listening(socket_path))
+        ret = run(cmd)
+        assert 0 == ret.code and 'export GREET="hi"' in ret.stdout
+        stop(socket_path)
+        assert wait_for(lambda: not os.path.exists(socket_path))
+        # Python clients spawn the server too
+        monkeypatch.setenv('PYTHONPATH', dirname(ppath(__file__)))
+        assert None is request(socket_path, script.conf, ['prog'])
+        assert wait_for(lambda: listening(socket_path))
+        ret = request(socket_path, script.conf, ['prog', '-E', 'greet: hi'])
+        assert 0 == ret['code'] and 'export GREET="hi"' in ret['stdout']
+        stop(socket_path)
+        assert wait_for(lambda: not os.path.exists(socket_path))
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+'''Test Watcher keeping a Config up to date with its source files
+
+For manual run:
+    python -m pytest tests/test_watch.py
+'''
+
+from loadconfig.lib import addpath
+addpath(__file__, parent=True)
+
+from loadconfig import Config
+from loadconfig.lib import tempdir, write_file
+from loadconfig.watch import Watcher
+import loadconfig.watch
+import os
+from pytest import mark, raises
+from queue import Empty, Queue
+
+
+def save(path, data):
+    '''Write a new file and rename it over path, as editors usually do'''
+    write_file(f'{path}.tmp', data)
+    os.rename(f'{path}.tmp', path)
+
+
+@mark.parametrize('inotify', [True, False])
+def test_watch_include_files(inotify):
+    changes = Queue()
+    with tempdir() as tmpdir:
+        write_file(f'{tmpdir}/db.yml', 'host: pg')
+        write_file(f'{tmpdir}/config.conf', 'port: 5432')
+        c = Config(f'db: !include {tmpdir}/db.yml\nurl: $db',
+            ['', f'-C={tmpdir}/config.conf'])
+        watcher = Watcher(c, interval=0.05, inotify=inotify)
+        watcher.subscribe(changes.put)
+        with watcher:
+            assert ('inotify' if inotify else 'poll') == watcher.backend
+            save(f'{tmpdir}/db.yml', 'host: mysql')
+            assert {'db', 'url'} == changes.get(timeout=5)
+            assert 'mysql' == c.url.host
+
+            # Files not loaded by the config are ignored
+            write_file(f'{tmpdir}/other.yml', 'a: 1')
+            with raises(Empty):
+                changes.get(timeout=0.2)
+
+            save(f'{tmpdir}/config.conf', 'port: [5432')
+            while watcher.error is None:
+                watcher.reload()
+            assert 5432 == c.port
+            with tempdir() as extra:
+                write_file(f'{extra}/extra.yml', 'retries: 3')
+                save(f'{tmpdir}/config.conf',
+                    f'port: 5433\nextra: !include {extra}/extra.yml')
+                assert {'port', 'extra'} == changes.get(timeout=5)
+                assert None is watcher.error
+                save(f'{extra}/extra.yml', 'retries: 4')
+                assert {'extra'} == changes.get(timeout=5)
+                save(f'{tmpdir}/config.conf', 'port: 5433')
+                assert {'extra'} == changes.get(timeout=5)
+        with raises(Empty):
+            changes.get(timeout=0.2)
+
+
+def test_watch_without_inotify(monkeypatch):
+    monkeypatch.setattr(loadconfig.watch, 'IN_NONBLOCK', -1)
+    with Watcher(Config()) as watcher:
+        assert 'poll' == watcher.backend